@@ -9,8 +9,30 @@ import time
 from datetime import datetime
 import random
 import subprocess
+import threading
+import asyncio
+import queue
+import sys
+import logging
+import traceback
+from logging.handlers import RotatingFileHandler
+import mmap
+import struct
+import glob
+import select
+import ctypes
+import ctypes.util
+import bisect
+import shutil
+from array import array
+from collections import OrderedDict, deque
 from gpiozero import Button as GPIOButton
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 MUSIC_END = pygame.USEREVENT + 1
 
 try:
@@ -21,6 +43,8 @@ except ImportError:
 # --- Configuration & Styling ---
 BG = "#2B2B2B"
 FG = "#FF8200"
+MUSIC_ROOT = "/home/dietpi/pidice/MP3s/"
+CONTROL_SOCKET = "/tmp/pidice.sock"
 
 
 def natural_sort(l):
@@ -29,6 +53,1724 @@ def natural_sort(l):
     return sorted(l, key=alphanum_key)
 
 
+def natural_key(text):
+    return [int(c) if c.isdigit() else c.lower() for c in re.split('([0-9]+)', text)]
+
+
+def is_m3u(path):
+    return path.lower().endswith((".m3u", ".m3u8"))
+
+
+def fmt_time(secs):
+    secs = max(0, int(secs))
+    return f"{secs // 60}:{secs % 60:02d}"
+
+
+# --- Playback Helpers ---
+
+class PlaybackClock:
+    """Monotonic track position. get_pos() ignores pauses and seeks, this doesn't."""
+
+    def __init__(self):
+        self.offset = 0.0
+        self.started = None
+
+    def start(self, offset=0.0, paused=False):
+        self.offset = offset
+        self.started = None if paused else time.monotonic()
+
+    def pause(self):
+        if self.started is not None:
+            self.offset += time.monotonic() - self.started
+            self.started = None
+
+    def resume(self):
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def position(self):
+        if self.started is None:
+            return self.offset
+        return self.offset + time.monotonic() - self.started
+
+
+class MP3FrameIndex:
+    """Byte offset of every MP3 frame (or the Xing TOC), so a seek is a lookup instead of a decode."""
+
+    BITRATES = {3: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+                2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]}
+    RATES = {3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000]}
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array('I')
+        self.toc = None
+        self.frames = 0
+        self.data_start = 0
+        self.data_end = 0
+        self.sample_rate = 44100
+        self.spf = 1152
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            self.data_end = len(mm)
+            if mm[-128:-125] == b"TAG":
+                self.data_end -= 128
+            pos = self.sync(mm, self.skip_id3(mm))
+            if pos < 0:
+                raise ValueError("no MP3 frames found")
+            self.data_start = pos
+            hdr = self.parse_header(mm, pos)
+            self.sample_rate, self.spf = hdr[1], hdr[2]
+            if not self.read_xing(mm, pos, hdr):
+                self.scan(mm, pos)
+
+    @property
+    def duration(self):
+        return self.frames * self.spf / self.sample_rate
+
+    @staticmethod
+    def skip_id3(mm):
+        if mm[:3] != b"ID3":
+            return 0
+        size = 0
+        for b in mm[6:10]:
+            size = (size << 7) | (b & 0x7F)
+        return 10 + size + (10 if mm[5] & 0x10 else 0)
+
+    @classmethod
+    def parse_header(cls, mm, pos):
+        """Returns (frame_len, sample_rate, samples_per_frame) or None for a bad header."""
+        if pos + 4 > len(mm) or mm[pos] != 0xFF or (mm[pos + 1] & 0xE0) != 0xE0:
+            return None
+        b1, b2 = mm[pos + 1], mm[pos + 2]
+        ver, layer = (b1 >> 3) & 3, (b1 >> 1) & 3
+        br_idx, sr_idx = b2 >> 4, (b2 >> 2) & 3
+        if ver == 1 or layer != 1 or br_idx in (0, 15) or sr_idx == 3:
+            return None
+        rate = cls.RATES[ver][sr_idx]
+        if ver == 3:
+            return 144000 * cls.BITRATES[3][br_idx] // rate + ((b2 >> 1) & 1), rate, 1152
+        return 72000 * cls.BITRATES[2][br_idx] // rate + ((b2 >> 1) & 1), rate, 576
+
+    @classmethod
+    def sync(cls, mm, pos, limit=65536):
+        """Finds the next frame header that is followed by another valid header."""
+        end = min(len(mm), pos + limit)
+        while pos < end:
+            pos = mm.find(b"\xFF", pos, end)
+            if pos < 0:
+                return -1
+            hdr = cls.parse_header(mm, pos)
+            if hdr and cls.parse_header(mm, pos + hdr[0]):
+                return pos
+            pos += 1
+        return -1
+
+    def read_xing(self, mm, pos, hdr):
+        mono = (mm[pos + 3] >> 6) == 3
+        if hdr[2] == 1152:
+            side = 17 if mono else 32
+        else:
+            side = 9 if mono else 17
+        x = pos + 4 + side
+        if mm[x:x + 4] not in (b"Xing", b"Info"):
+            return False
+        flags = struct.unpack(">I", mm[x + 4:x + 8])[0]
+        x += 8
+        if not flags & 1:
+            return False
+        self.frames = struct.unpack(">I", mm[x:x + 4])[0]
+        x += 4
+        if flags & 2:
+            self.data_end = min(self.data_end, pos + struct.unpack(">I", mm[x:x + 4])[0])
+            x += 4
+        if not flags & 4:
+            return False
+        self.toc = bytes(mm[x:x + 100])
+        # The Xing frame itself is silent, real audio starts at the next one
+        self.data_start = pos + hdr[0]
+        return True
+
+    def scan(self, mm, pos):
+        offsets, end = self.offsets, self.data_end
+        while pos < end:
+            hdr = self.parse_header(mm, pos)
+            if not hdr:
+                pos = self.sync(mm, pos + 1)
+                if pos < 0:
+                    break
+                continue
+            offsets.append(pos)
+            pos += hdr[0]
+        self.frames = len(offsets)
+
+    def locate(self, secs):
+        """Returns (byte_offset, exact_start_secs) of the frame playing at `secs`."""
+        frame = max(0, min(int(secs * self.sample_rate / self.spf), self.frames - 1))
+        if self.toc is None:
+            return self.offsets[frame], frame * self.spf / self.sample_rate
+        pct = min(99.999, max(0.0, secs * 100.0 / self.duration))
+        a = int(pct)
+        fa = self.toc[a]
+        fb = self.toc[a + 1] if a < 99 else 256
+        rel = (fa + (fb - fa) * (pct - a)) / 256.0
+        guess = self.data_start + int(rel * (self.data_end - self.data_start))
+        # TOC entries are approximate, snap forward to the next real frame header
+        with open(self.path, "rb") as f:
+            f.seek(guess)
+            skip = self.sync(f.read(16384), 0)
+        return guess + max(0, skip), secs
+
+
+def open_at(path, offset):
+    """Unbuffered file positioned on a frame boundary, handed to pygame to start mid-track.
+
+    pygame reads anything with a fileno() straight from the fd, without taking the GIL on SDL's
+    audio thread, and SDL_mixer treats the position it is given as the start of the stream. A
+    Python file-like wrapper would make every decoder read wait on Tk and the worker threads.
+    """
+    f = open(path, "rb", buffering=0)
+    f.seek(offset)
+    return f
+
+
+class Library:
+    """Interns track paths to small integer IDs so queues can be flat int arrays."""
+
+    def __init__(self):
+        self.paths = []
+        self.ids = {}
+
+    def add(self, path):
+        tid = self.ids.get(path)
+        if tid is None:
+            tid = self.ids[path] = len(self.paths)
+            self.paths.append(path)
+        return tid
+
+    def path(self, tid):
+        return self.paths[tid]
+
+
+class PlayQueue:
+    """Track IDs in a doubly linked list laid over flat arrays.
+
+    Entries are addressed by slot, so enqueue, play-next, remove and move are all O(1);
+    freed slots are reused.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.tracks, self.nxt, self.prv = array('i'), array('i'), array('i')
+        self.free = array('i')
+        self.head = self.tail = self.cur = -1
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        slot = self.head
+        while slot >= 0:
+            yield slot, self.tracks[slot]
+            slot = self.nxt[slot]
+
+    def valid(self, slot):
+        return 0 <= slot < len(self.tracks) and self.tracks[slot] >= 0
+
+    def current(self):
+        return self.tracks[self.cur] if self.cur >= 0 else None
+
+    def link_after(self, slot, after):
+        """Links an unlinked slot after `after`, or at the head when after is -1."""
+        nxt = self.head if after < 0 else self.nxt[after]
+        self.prv[slot], self.nxt[slot] = after, nxt
+        if after < 0:
+            self.head = slot
+        else:
+            self.nxt[after] = slot
+        if nxt < 0:
+            self.tail = slot
+        else:
+            self.prv[nxt] = slot
+
+    def unlink(self, slot):
+        p, n = self.prv[slot], self.nxt[slot]
+        if p < 0:
+            self.head = n
+        else:
+            self.nxt[p] = n
+        if n < 0:
+            self.tail = p
+        else:
+            self.prv[n] = p
+
+    def insert_after(self, after, tid):
+        if self.free:
+            slot = self.free.pop()
+            self.tracks[slot] = tid
+        else:
+            slot = len(self.tracks)
+            self.tracks.append(tid)
+            self.nxt.append(-1)
+            self.prv.append(-1)
+        self.link_after(slot, after)
+        self.size += 1
+        return slot
+
+    def append(self, tid):
+        return self.insert_after(self.tail, tid)
+
+    def play_next(self, tid):
+        return self.insert_after(self.cur if self.cur >= 0 else self.tail, tid)
+
+    def remove(self, slot):
+        if not self.valid(slot): raise KeyError(slot)
+        if slot == self.cur:
+            # Step back so the track after the removed one still plays next
+            self.cur = self.prv[slot]
+        self.unlink(slot)
+        self.tracks[slot] = -1
+        self.free.append(slot)
+        self.size -= 1
+
+    def move(self, slot, after):
+        if not self.valid(slot) or (after >= 0 and not self.valid(after)): raise KeyError(slot)
+        if slot == after: return
+        self.unlink(slot)
+        self.link_after(slot, after)
+
+    def step(self, d, wrap=True):
+        """Slot d entries away from the current one (d is +1 or -1), -1 past the end."""
+        if self.cur < 0:
+            return self.head
+        slot = self.nxt[self.cur] if d > 0 else self.prv[self.cur]
+        if slot < 0 and wrap:
+            slot = self.head if d > 0 else self.tail
+        return slot
+
+
+def iter_m3u(path):
+    """Yields absolute track paths from an M3U/M3U8 file one line at a time."""
+    base = os.path.dirname(path)
+    enc = "utf-8" if path.lower().endswith(".m3u8") else "latin-1"
+    with open(path, encoding=enc, errors="replace") as f:
+        for line in f:
+            line = line.strip().lstrip("\ufeff")
+            if not line or line.startswith("#") or "://" in line:
+                continue
+            yield os.path.normpath(os.path.join(base, line.replace("\\", "/")))
+
+
+class Inotify:
+    """Minimal ctypes binding to the kernel's inotify, no third-party module needed."""
+
+    IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x2, 0x8, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF = 0x100, 0x200, 0x400, 0x800
+    IN_UNMOUNT, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x2000, 0x4000, 0x8000, 0x40000000
+    CHANGES = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add(self, path, mask=CHANGES):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"cannot watch {path}")
+        return wd
+
+    def remove(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """Yields (wd, mask, name) for every queued event."""
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _, size = self.EVENT.unpack_from(buf, pos)
+            pos += self.EVENT.size
+            name = os.fsdecode(buf[pos:pos + size].rstrip(b"\0"))
+            pos += size
+            yield wd, mask, name
+
+
+class LibraryWatcher:
+    """Keeps the set of album folders and M3U files under every library root up to date.
+
+    Roots are the configured ones plus removable mounts under /media and /mnt, picked up
+    from /proc/mounts change notifications. Each root is listed once when it appears; after
+    that inotify events are batched and pushed to App.library_changed, never rescanned.
+    """
+
+    REMOVABLE_FS = ("vfat", "exfat", "ntfs", "ntfs3", "fuseblk", "ext4", "ext3", "ext2", "hfsplus", "btrfs", "f2fs")
+    BATCH_DELAY = 500
+
+    def __init__(self, app, roots, auto_mounts=True):
+        self.app = app
+        self.static_roots = [os.path.normpath(r) for r in roots]
+        self.auto_mounts = auto_mounts
+        self.roots = set()
+        self.wds = {}
+        self.entries = set()
+        self.added, self.removed, self.touched = set(), set(), set()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name="library-watcher").start()
+
+    @classmethod
+    def removable_mounts(cls):
+        mounts = []
+        try:
+            with open("/proc/mounts") as f:
+                for line in f:
+                    parts = line.split()
+                    point = parts[1].replace("\\040", " ")
+                    if parts[2] in cls.REMOVABLE_FS and point.startswith(("/media/", "/mnt/")):
+                        mounts.append(point)
+        except OSError:
+            pass
+        return mounts
+
+    def run(self):
+        try:
+            self.ino = Inotify()
+        except (OSError, AttributeError) as e:
+            print(f"Library Watcher Error: {e}")
+            self.ino = None
+        poller = select.poll()
+        if self.ino:
+            poller.register(self.ino.fd, select.POLLIN)
+        mounts = open("/proc/mounts")
+        # /proc/mounts raises POLLPRI whenever something is mounted or unmounted
+        poller.register(mounts, select.POLLPRI)
+        self.sync_roots()
+        self.flush()
+        while True:
+            pending = self.added or self.removed or self.touched
+            ready = poller.poll(self.BATCH_DELAY if pending else None)
+            if not ready:
+                self.flush()
+                continue
+            for fd, _ in ready:
+                if self.ino and fd == self.ino.fd:
+                    self.handle_events()
+                else:
+                    mounts.seek(0)
+                    mounts.read()
+                    self.sync_roots()
+
+    def sync_roots(self):
+        want = set(r for r in self.static_roots if os.path.isdir(r))
+        if self.auto_mounts:
+            want.update(self.removable_mounts())
+        for root in want - self.roots:
+            self.add_root(root)
+        for root in self.roots - want:
+            self.drop_root(root)
+
+    def watch(self, path):
+        if self.ino:
+            try:
+                self.wds[self.ino.add(path)] = path
+            except OSError:
+                pass
+
+    def add_root(self, root):
+        self.roots.add(root)
+        self.watch(root)
+        try:
+            names = os.listdir(root)
+        except OSError:
+            return
+        for name in names:
+            self.add_entry(os.path.join(root, name))
+
+    def drop_root(self, root):
+        self.roots.discard(root)
+        prefix = root.rstrip("/") + "/"
+        for entry in [e for e in self.entries if e.startswith(prefix)]:
+            self.drop_entry(entry)
+        for wd, path in list(self.wds.items()):
+            if path == root or path.startswith(prefix):
+                self.forget(wd)
+
+    def add_entry(self, path):
+        if path in self.entries: return
+        if os.path.isdir(path):
+            self.watch(path)
+        elif not is_m3u(path):
+            return
+        self.entries.add(path)
+        self.removed.discard(path)
+        self.added.add(path)
+
+    def drop_entry(self, path):
+        if path not in self.entries: return
+        for wd, watched in list(self.wds.items()):
+            if watched == path:
+                self.forget(wd)
+        self.entries.discard(path)
+        self.added.discard(path)
+        self.removed.add(path)
+
+    def forget(self, wd):
+        self.wds.pop(wd, None)
+        if self.ino:
+            self.ino.remove(wd)
+
+    def rescan(self):
+        """Re-lists every root after the kernel dropped events, diffing against what we know."""
+        for root in list(self.roots):
+            try:
+                names = os.listdir(root)
+            except OSError:
+                continue
+            present = set(os.path.join(root, n) for n in names)
+            prefix = root.rstrip("/") + "/"
+            for entry in [e for e in self.entries if e.startswith(prefix) and e not in present]:
+                self.drop_entry(entry)
+            for path in present:
+                self.add_entry(path)
+            # Track changes inside albums may be among the lost events too
+            self.touched.update(e for e in self.entries if e.startswith(prefix) and not is_m3u(e))
+
+    def handle_events(self):
+        overflow = False
+        for wd, mask, name in self.ino.read():
+            if mask & Inotify.IN_Q_OVERFLOW:
+                # A big copy onto a stick can outrun the kernel queue, events were lost
+                overflow = True
+                continue
+            base = self.wds.get(wd)
+            if base is None:
+                continue
+            if mask & Inotify.IN_IGNORED:
+                self.wds.pop(wd, None)
+                continue
+            if mask & (Inotify.IN_UNMOUNT | Inotify.IN_DELETE_SELF | Inotify.IN_MOVE_SELF):
+                # Album folders are tracked through their root's events, only a vanished root matters here
+                if base in self.roots:
+                    self.drop_root(base)
+                continue
+            path = os.path.join(base, name)
+            gone = mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM)
+            if base in self.roots:
+                if gone:
+                    self.drop_entry(path)
+                else:
+                    self.add_entry(path)
+            elif name.lower().endswith((".mp3", ".png")):
+                # A track or the cover changed inside an album folder
+                self.touched.add(base)
+        if overflow:
+            self.rescan()
+
+    def flush(self):
+        if not (self.added or self.removed or self.touched): return
+        self.app.post(self.app.library_changed, self.added, self.removed, self.touched)
+        self.added, self.removed, self.touched = set(), set(), set()
+
+
+class ImageCache:
+    """Resized cover PhotoImages shared by every screen, capped by a byte budget with LRU eviction.
+
+    Screens pin the keys they are currently showing: Tk only holds images by name, so
+    evicting one that is still on a Canvas or Label would blank it.
+    """
+
+    def __init__(self, budget_mb=24):
+        self.budget = budget_mb * 1024 * 1024
+        self.entries = OrderedDict()
+        self.used = 0
+        self.pinned = {}
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, path, size):
+        key = (path, size)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+        self.misses += 1
+        img = Image.open(path) if os.path.exists(path) else Image.new('RGB', size, color='#111')
+        photo = ImageTk.PhotoImage(img.resize(size, Image.Resampling.LANCZOS))
+        # Tk keeps a 32-bit pixel buffer per image
+        nbytes = size[0] * size[1] * 4
+        self.entries[key] = (photo, nbytes)
+        self.used += nbytes
+        self.evict()
+        return photo
+
+    def invalidate(self, path):
+        """Drops every size of one image, e.g. after a cover.png was replaced."""
+        for key in [k for k in self.entries if k[0] == path]:
+            self.used -= self.entries.pop(key)[1]
+
+    def pin(self, owner, keys):
+        """Replaces what `owner` has on screen, releasing whatever it showed before."""
+        self.pinned[owner] = set(keys)
+        self.evict()
+
+    def evict(self):
+        if self.used <= self.budget: return
+        protected = set().union(*self.pinned.values())
+        for key in list(self.entries):
+            if self.used <= self.budget:
+                break
+            if key in protected:
+                continue
+            self.used -= self.entries.pop(key)[1]
+            self.evictions += 1
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.used, "budget": self.budget,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class AudioTuner:
+    """Per-output mixer profiles that start at low latency and grow the buffer on underruns.
+
+    SDL doesn't report underruns, so this reads the kernel's view of our PCM stream from
+    /proc/asound: an XRUN state, or avail_max reaching the buffer size, means the buffer ran dry.
+    """
+
+    BUFFERS = [512, 1024, 2048, 4096, 8192]
+
+    def __init__(self, profiles):
+        self.profiles = profiles
+        self.pending = False
+        self.underruns = 0
+
+    def profile(self, output):
+        if output not in self.profiles:
+            # Bluetooth sinks have their own jitter, start them where the old fixed setting was
+            start = 4096 if "blue" in output.lower() else 1024
+            self.profiles[output] = {"buffer": start, "rate": 44100}
+        return self.profiles[output]
+
+    @staticmethod
+    def read_proc(path):
+        info = {}
+        try:
+            with open(path) as f:
+                for line in f:
+                    if ":" in line:
+                        k, v = line.split(":", 1)
+                        info[k.strip()] = v.strip()
+        except OSError:
+            pass
+        return info
+
+    def find_stream(self):
+        """Returns (status, hw_params) of the playback substream this process owns."""
+        pid = str(os.getpid())
+        for status_p in glob.glob("/proc/asound/card*/pcm*p/sub*/status"):
+            status = self.read_proc(status_p)
+            if status.get("owner_pid") == pid:
+                return status, self.read_proc(os.path.join(os.path.dirname(status_p), "hw_params"))
+        return None, None
+
+    def poll(self, output):
+        """Checks the running stream once, returns True when the profile changed."""
+        if self.pending: return False
+        status, hw = self.find_stream()
+        if not status or not hw: return False
+        prof = self.profile(output)
+        changed = False
+        try:
+            buf = int(hw.get("buffer_size", 0))
+            ran_dry = status.get("state") == "XRUN" or (buf and int(status.get("avail_max", 0)) >= buf)
+            hw_rate = int(hw.get("rate", "0").split()[0])
+        except ValueError:
+            return False
+        if ran_dry:
+            self.underruns += 1
+            bigger = [b for b in self.BUFFERS if b > prof["buffer"]]
+            if bigger:
+                prof["buffer"] = bigger[0]
+                changed = True
+        if hw_rate and hw_rate != prof["rate"]:
+            # plughw is resampling for us, open at the card's native rate instead
+            prof["rate"] = hw_rate
+            changed = True
+        self.pending = self.pending or changed
+        return changed
+
+
+def biquad(kind, f0, gain_db, q, rate):
+    """RBJ cookbook coefficients as (b0, b1, b2, a1, a2), normalised to a0 = 1."""
+    A = 10 ** (gain_db / 40)
+    w0 = 2 * 3.141592653589793 * f0 / rate
+    cw, alpha = np.cos(w0), np.sin(w0) / (2 * q)
+    sa = 2 * A ** 0.5 * alpha
+    if kind == "peak":
+        b = (1 + alpha * A, -2 * cw, 1 - alpha * A)
+        a = (1 + alpha / A, -2 * cw, 1 - alpha / A)
+    elif kind == "low":
+        b = (A * ((A + 1) - (A - 1) * cw + sa), 2 * A * ((A - 1) - (A + 1) * cw), A * ((A + 1) - (A - 1) * cw - sa))
+        a = ((A + 1) + (A - 1) * cw + sa, -2 * ((A - 1) + (A + 1) * cw), (A + 1) + (A - 1) * cw - sa)
+    elif kind == "high":
+        b = (A * ((A + 1) + (A - 1) * cw + sa), -2 * A * ((A - 1) + (A + 1) * cw), A * ((A + 1) + (A - 1) * cw - sa))
+        a = ((A + 1) - (A - 1) * cw + sa, 2 * ((A - 1) - (A + 1) * cw), (A + 1) - (A - 1) * cw - sa)
+    else:  # "hp"
+        b = ((1 + cw) / 2, -(1 + cw), (1 + cw) / 2)
+        a = (1 + alpha, -2 * cw, 1 - alpha)
+    return b[0] / a[0], b[1] / a[0], b[2] / a[0], a[1] / a[0], a[2] / a[0]
+
+
+class Equalizer:
+    """Biquad cascade, preamp and peak limiter over int16 stereo PCM, in BLOCK sized steps.
+
+    A biquad is a per-sample recursion, so instead of looping in Python the cascade is turned
+    into one state-space system (A, B, C, D). For a block of N samples the output is then the
+    block convolved with the first N taps of the impulse response (one FFT), plus O @ state for
+    what the previous block left ringing. The state carried to the next block is
+    A^N @ state + K @ block. All of it is matrix work, and every block of a chunk goes through
+    one batched FFT.
+    """
+
+    BLOCK = 1024
+    CEILING = 0.98
+    RELEASE = 0.2
+    # name: (preamp dB, [(kind, Hz, gain dB, Q)])
+    PRESETS = {
+        "FLAT": (0, []),
+        "SMALL SPEAKER": (-4, [("hp", 90, 0, 0.7), ("peak", 300, -2, 1.0), ("high", 6000, 4, 0.7)]),
+        "BASS BOOST": (-6, [("low", 110, 6, 0.7)]),
+        "TREBLE": (-5, [("high", 5000, 5, 0.7)]),
+        "LOUDNESS": (-6, [("low", 120, 5, 0.7), ("high", 8000, 3, 0.7)]),
+        "VOCAL": (-4, [("low", 150, -3, 0.7), ("peak", 2500, 4, 1.0)]),
+    }
+
+    def __init__(self, preset="FLAT", budget=0.25):
+        self.preset = preset if preset in self.PRESETS else "FLAT"
+        self.budget = budget
+        self.rate = 44100
+        self.load = 0.0
+        self.bypassed = False
+        self.design(self.rate)
+
+    def set_preset(self, preset):
+        self.preset = preset if preset in self.PRESETS else "FLAT"
+        self.load, self.bypassed = 0.0, False
+        self.design(self.rate)
+
+    def design(self, rate):
+        self.rate = rate
+        preamp_db, bands = self.PRESETS[self.preset]
+        self.preamp = 10 ** (preamp_db / 20)
+        n, N = 2 * len(bands), self.BLOCK
+        A, B, C, D = np.zeros((n, n)), np.zeros(n), np.zeros(n), 1.0
+        for i, band in enumerate(bands):
+            b0, b1, b2, a1, a2 = biquad(*band, rate)
+            # Chain section i (transposed direct form II) onto the output of the cascade so far
+            k = 2 * i
+            Bi = np.array([b1 - a1 * b0, b2 - a2 * b0])
+            A[k:k + 2, :k] = np.outer(Bi, C[:k])
+            A[k:k + 2, k:k + 2] = [[-a1, 1], [-a2, 0]]
+            B[k:k + 2] = Bi * D
+            C[:k] *= b0
+            C[k] = 1
+            D *= b0
+        O, K, h = np.empty((N, n)), np.empty((n, N)), np.empty(N)
+        P = np.eye(n)
+        h[0] = D
+        for i in range(N):
+            O[i] = C @ P
+            K[:, N - 1 - i] = P @ B
+            if i + 1 < N:
+                h[i + 1] = O[i] @ B
+            P = A @ P
+        self.O, self.K, self.AN = O, K, P
+        self.H = np.fft.rfft(h, 2 * N)
+        self.reset()
+
+    def reset(self):
+        self.state = np.zeros((len(self.AN), 2))
+        self.gain = 1.0
+
+    def process(self, pcm):
+        """Filters an int16 (frames, 2) array and returns int16 of the same shape."""
+        m = len(pcm)
+        if self.bypassed or not m:
+            return pcm
+        start = time.perf_counter()
+        N = self.BLOCK
+        nb = -(-m // N)
+        x = np.zeros((nb * N, 2))
+        x[:m] = pcm
+        x *= 1 / 32768
+        if len(self.state):
+            xb = x.reshape(nb, N, 2)
+            y = np.fft.irfft(np.fft.rfft(xb, 2 * N, axis=1) * self.H[:, None], 2 * N, axis=1)[:, :N]
+            kx = np.einsum("kn,bnc->bkc", self.K, xb)
+            states = np.empty((nb,) + self.state.shape)
+            s = self.state
+            for j in range(nb):
+                states[j] = s
+                s = self.AN @ s + kx[j]
+            # Only the last block of a stream may be zero-padded, DspEngine.feed carries short
+            # reads over so the state stays exact across chunks and gapless joins
+            self.state = s
+            y += np.einsum("nk,bkc->bnc", self.O, states)
+            y = y.reshape(-1, 2)[:m]
+        else:
+            y = x[:m]
+        y *= self.preamp
+        # Limiter: clamp at once to the chunk's peak, recover over a few chunks
+        peak = np.abs(y).max()
+        target = min(1.0, self.CEILING / peak) if peak else 1.0
+        gain = target if target < self.gain else min(target, self.gain + (1 - self.gain) * self.RELEASE)
+        if gain < self.gain or self.gain < 1.0:
+            y *= np.linspace(min(gain, self.gain), gain, m)[:, None]
+        self.gain = gain
+        out = np.clip(y * 32768, -32768, 32767).astype(np.int16)
+        # Past the budget the DSP would eat into the decoder's headroom, so drop it for good
+        load = (time.perf_counter() - start) * self.rate / m
+        self.load += (load - self.load) * 0.2
+        if self.load > self.budget:
+            self.bypassed = True
+            print(f"DSP over budget ({self.load:.0%} of a core), bypassing EQ")
+        return out
+
+
+def bench_dsp(seconds=10, rate=44100):
+    """`python main.py --bench-dsp`: CPU cost of each EQ preset per second of audio."""
+    pcm = (np.random.default_rng(0).standard_normal((seconds * rate, 2)) * 4000).astype(np.int16)
+    chunk = Equalizer.BLOCK * DspEngine.CHUNK_BLOCKS
+    for name in Equalizer.PRESETS:
+        eq = Equalizer(name, budget=float("inf"))
+        eq.design(rate)
+        start = time.perf_counter()
+        for i in range(0, len(pcm), chunk):
+            eq.process(pcm[i:i + chunk])
+        cost = (time.perf_counter() - start) / seconds
+        print(f"{name:<14} {cost * 1000:7.2f} ms per second of audio ({cost:.1%} of one core)")
+
+
+# --- Playback Engines ---
+
+class PlaybackEngine:
+    """Audio backend behind App. Positions are seconds; poll() returns the
+    end-of-track events since the last call: "ended", or "advanced" when the
+    engine rolled straight into the path given to queue_next().
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self.clock = PlaybackClock()
+        self.path = None
+        self.next_path = None
+        self.paused = False
+        self.volume = 1.0
+
+    def open(self, device, rate, buffer):
+        """(Re)opens the audio output. device is an ALSA name or None for the default."""
+
+    def load(self, path, start=0.0, index=None):
+        """Starts `path` playing from `start`, dropping anything queued."""
+        raise NotImplementedError
+
+    def pause(self):
+        raise NotImplementedError
+
+    def resume(self):
+        raise NotImplementedError
+
+    def seek(self, secs, index=None):
+        """Jumps within the loaded track and returns the position actually landed on."""
+        raise NotImplementedError
+
+    def set_volume(self, level):
+        self.volume = level
+
+    def queue_next(self, path):
+        self.next_path = path
+
+    def position(self):
+        return self.clock.position()
+
+    def stop(self):
+        self.path = self.next_path = None
+
+    def poll(self):
+        return []
+
+    def close(self):
+        self.stop()
+
+
+class PygameEngine(PlaybackEngine):
+    """In-process decoding through pygame.mixer.music."""
+
+    name = "pygame"
+
+    def __init__(self):
+        super().__init__()
+        self.slice = None
+        try:
+            # Audio callbacks run in this process, so the whole process gets the priority.
+            # Absolute, so building another engine doesn't stack it.
+            os.setpriority(os.PRIO_PROCESS, 0, -10)
+        except OSError:
+            pass
+
+    def open(self, device, rate, buffer):
+        # SDL's ALSA backend opens $AUDIODEV when no device name is given
+        if device:
+            os.environ["AUDIODEV"] = device
+        else:
+            os.environ.pop("AUDIODEV", None)
+        pygame.mixer.quit()
+        pygame.mixer.init(rate, -16, 2, buffer)
+        if not pygame.get_init():
+            pygame.init()
+        pygame.mixer.music.set_endevent(MUSIC_END)
+
+    def close_slice(self):
+        if self.slice:
+            self.slice.close()
+            self.slice = None
+
+    def load(self, path, start=0.0, index=None):
+        pygame.mixer.music.set_endevent(0)
+        pygame.mixer.music.stop()
+        pygame.mixer.music.load(path)
+        # Loading resets the music volume to full
+        pygame.mixer.music.set_volume(self.volume)
+        pygame.mixer.music.play()
+        pygame.mixer.music.set_endevent(MUSIC_END)
+        self.close_slice()
+        self.path, self.next_path, self.paused = path, None, False
+        self.clock.start(0.0)
+        if start:
+            self.seek(start, index)
+
+    def pause(self):
+        pygame.mixer.music.pause()
+        self.paused = True
+        self.clock.pause()
+
+    def resume(self):
+        pygame.mixer.music.unpause()
+        self.paused = False
+        self.clock.resume()
+
+    def seek(self, secs, index=None):
+        pygame.mixer.music.set_endevent(0)
+        old_slice = self.slice
+        if index:
+            offset, secs = index.locate(secs)
+            self.slice = open_at(self.path, offset)
+            pygame.mixer.music.load(self.slice, "mp3")
+            pygame.mixer.music.play()
+        else:
+            # Index still building: let the decoder seek on its own
+            pygame.mixer.music.play(start=secs)
+        if old_slice and old_slice is not self.slice:
+            old_slice.close()
+        pygame.mixer.music.set_volume(self.volume)
+        if self.next_path:
+            pygame.mixer.music.queue(self.next_path)
+        if self.paused:
+            pygame.mixer.music.pause()
+        pygame.mixer.music.set_endevent(MUSIC_END)
+        self.clock.start(secs, paused=self.paused)
+        return secs
+
+    def set_volume(self, level):
+        self.volume = level
+        pygame.mixer.music.set_volume(level)
+
+    def queue_next(self, path):
+        self.next_path = path
+        if path:
+            pygame.mixer.music.queue(path)
+
+    def stop(self):
+        super().stop()
+        if pygame.mixer.get_init():
+            pygame.mixer.music.stop()
+        self.close_slice()
+
+    def close(self):
+        # Release the ALSA device so a following mpg123 child can open it
+        self.stop()
+        pygame.mixer.quit()
+
+    def poll(self):
+        events = []
+        for event in pygame.event.get():
+            if event.type != MUSIC_END:
+                continue
+            if self.next_path and pygame.mixer.music.get_busy():
+                # pygame already rolled over into the queued track
+                self.path, self.next_path = self.next_path, None
+                self.close_slice()
+                self.clock.start(0.0)
+                events.append("advanced")
+            else:
+                if pygame.mixer.music.get_busy():
+                    # pygame can't unqueue: a track queued before queue_next(None) started anyway
+                    pygame.mixer.music.set_endevent(0)
+                    pygame.mixer.music.stop()
+                    pygame.mixer.music.set_endevent(MUSIC_END)
+                events.append("ended")
+        return events
+
+
+class Mpg123Engine(PlaybackEngine):
+    """Decodes in an mpg123 child at real-time priority, driven over its -R stdin/stdout pipe.
+
+    The Tk process only writes one-line commands, so UI work can no longer starve the decoder.
+    """
+
+    name = "mpg123"
+
+    def __init__(self):
+        super().__init__()
+        self.proc = None
+        self.events = queue.SimpleQueue()
+        self.loading = False
+
+    @staticmethod
+    def realtime(proc):
+        """Raises an already running child. preexec_fn isn't safe here, the app has threads."""
+        try:
+            os.sched_setscheduler(proc.pid, os.SCHED_FIFO, os.sched_param(20))
+        except (AttributeError, OSError):
+            try:
+                os.setpriority(os.PRIO_PROCESS, proc.pid, -10)
+            except OSError:
+                pass
+        return proc
+
+    def open(self, device, rate, buffer):
+        self.close()
+        cmd = ["mpg123", "-R", "-o", "alsa"] + (["-a", device] if device else [])
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, text=True, bufsize=1)
+        self.realtime(self.proc)
+        threading.Thread(target=self.read_loop, args=(self.proc,), daemon=True).start()
+        # No per-frame @F chatter, position comes from the clock
+        self.send("SILENCE")
+        self.set_volume(self.volume)
+
+    def send(self, line):
+        try:
+            self.proc.stdin.write(line + "\n")
+            self.proc.stdin.flush()
+        except (AttributeError, OSError, ValueError):
+            pass
+
+    def read_loop(self, proc):
+        for line in proc.stdout:
+            if line.startswith("@P 2"):
+                self.loading = False
+            elif line.startswith("@P 0") and not self.loading:
+                self.events.put("ended")
+            elif line.startswith("@E"):
+                print(f"mpg123: {line.strip()}")
+
+    def load(self, path, start=0.0, index=None):
+        self.loading = True
+        self.send(f"L {path}")
+        self.path, self.next_path, self.paused = path, None, False
+        self.clock.start(0.0)
+        if start:
+            self.seek(start)
+
+    def pause(self):
+        if not self.paused:
+            self.send("P")
+        self.paused = True
+        self.clock.pause()
+
+    def resume(self):
+        if self.paused:
+            self.send("P")
+        self.paused = False
+        self.clock.resume()
+
+    def seek(self, secs, index=None):
+        self.send(f"J {secs:.2f}s")
+        self.clock.start(secs, paused=self.paused)
+        return secs
+
+    def set_volume(self, level):
+        self.volume = level
+        self.send(f"V {level * 100:.0f}")
+
+    def stop(self):
+        super().stop()
+        self.loading = True
+        self.send("S")
+
+    def poll(self):
+        events = []
+        while True:
+            try:
+                ev = self.events.get_nowait()
+            except queue.Empty:
+                return events
+            if ev == "ended" and self.next_path:
+                self.load(self.next_path)
+                ev = "advanced"
+            events.append(ev)
+
+    def close(self):
+        if self.proc:
+            self.send("Q")
+            try:
+                self.proc.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+            self.proc = None
+
+
+class DummyEngine(PlaybackEngine):
+    """Plays nothing: tracks run on the clock for their tagged length. For tests and benchmarks."""
+
+    name = "dummy"
+
+    def __init__(self, default_length=180.0):
+        super().__init__()
+        self.default_length = default_length
+        self.length = 0.0
+
+    def track_length(self, path):
+        try:
+            return MP3(path).info.length
+        except:
+            return self.default_length
+
+    def load(self, path, start=0.0, index=None):
+        self.path, self.next_path, self.paused = path, None, False
+        self.length = self.track_length(path)
+        self.clock.start(start)
+
+    def pause(self):
+        self.paused = True
+        self.clock.pause()
+
+    def resume(self):
+        self.paused = False
+        self.clock.resume()
+
+    def seek(self, secs, index=None):
+        self.clock.start(secs, paused=self.paused)
+        return secs
+
+    def poll(self):
+        if not self.path or self.position() < self.length:
+            return []
+        if self.next_path:
+            self.load(self.next_path)
+            return ["advanced"]
+        self.path = None
+        return ["ended"]
+
+
+class DspEngine(PygameEngine):
+    """mpg123 decodes to raw PCM on a pipe, the Equalizer filters it and the result is queued
+    chunk by chunk on a pygame mixer channel. Needs numpy.
+
+    A feeder thread keeps one chunk queued behind the one playing. Each decoder restart bumps
+    `gen`, so a feeder that lost the race drops its chunk instead of queueing stale audio.
+    """
+
+    name = "dsp"
+    CHUNK_BLOCKS = 8  # ~186 ms per queued Sound at 44.1 kHz
+
+    def __init__(self):
+        super().__init__()
+        self.eq = Equalizer()
+        self.rate = 44100
+        self.channel = None
+        self.gen = 0
+        self.lock = threading.Lock()
+        self.events = queue.SimpleQueue()
+
+    def open(self, device, rate, buffer):
+        self.stop()
+        super().open(device, rate, buffer)
+        self.rate = pygame.mixer.get_init()[0]
+        with self.lock:
+            self.eq.design(self.rate)
+        self.channel = pygame.mixer.Channel(0)
+        self.channel.set_volume(self.volume)
+
+    def set_eq(self, preset):
+        with self.lock:
+            self.eq.set_preset(preset)
+
+    def decoder(self, path, offset=0, skip=0):
+        cmd = ["mpg123", "-q", "-s", "--stereo", "-e", "s16", "-r", str(self.rate)]
+        if skip:
+            cmd += ["-k", str(skip)]
+        with open(path, "rb") as src:
+            src.seek(offset)
+            return Mpg123Engine.realtime(subprocess.Popen(cmd + ["-"], stdin=src, stdout=subprocess.PIPE,
+                                                          stderr=subprocess.DEVNULL))
+
+    def restart(self, proc):
+        with self.lock:
+            self.gen += 1
+            self.eq.reset()
+            if self.channel:
+                self.channel.stop()
+        threading.Thread(target=self.feed, args=(self.gen, proc), daemon=True, name="dsp").start()
+
+    def feed(self, gen, proc):
+        size = Equalizer.BLOCK * self.CHUNK_BLOCKS * 4
+        boundary = None
+        carry = b""
+        while gen == self.gen:
+            data = proc.stdout.read(size)
+            if not data:
+                proc.wait()
+                nxt = self.next_path
+                if nxt:
+                    # Gapless: keep the filter state and the leftover samples, roll straight on
+                    try:
+                        proc, boundary = self.decoder(nxt), nxt
+                        continue
+                    except OSError as e:
+                        print(f"DSP Error: {e}")
+                if not carry:
+                    while gen == self.gen and self.channel.get_busy():
+                        time.sleep(0.02)
+                    self.events.put((gen, "ended", None))
+                    return
+                # Real end of the stream: the only place a partial block goes through
+                data, carry = carry[:len(carry) & ~3], b""
+            else:
+                # Keep the filter fed whole blocks, a short read leaves its tail for the next one
+                data = carry + data
+                cut = len(data) - len(data) % (Equalizer.BLOCK * 4)
+                data, carry = data[:cut], data[cut:]
+                if not data:
+                    continue
+            pcm = np.frombuffer(data, np.int16).reshape(-1, 2)
+            while gen == self.gen and self.channel.get_queue() is not None:
+                time.sleep(0.005)
+            with self.lock:
+                if gen != self.gen:
+                    break
+                sound = pygame.mixer.Sound(buffer=self.eq.process(pcm).tobytes())
+                if self.channel.get_busy():
+                    self.channel.queue(sound)
+                else:
+                    self.channel.play(sound)
+                    self.channel.set_volume(self.volume)
+                    # play() clears SDL_mixer's pause flag, e.g. after a seek while paused
+                    if self.paused:
+                        self.channel.pause()
+            if boundary:
+                # Report the switch once the first chunk of the new file is actually playing
+                while gen == self.gen and self.channel.get_queue() is not None:
+                    time.sleep(0.005)
+                self.events.put((gen, "advanced", boundary))
+                boundary = None
+        proc.kill()
+        proc.wait()
+
+    def load(self, path, start=0.0, index=None):
+        self.path, self.next_path, self.paused = path, None, False
+        self.seek(start, index)
+
+    def pause(self):
+        with self.lock:
+            if self.channel:
+                self.channel.pause()
+            self.paused = True
+        self.clock.pause()
+
+    def resume(self):
+        with self.lock:
+            if self.channel:
+                self.channel.unpause()
+            self.paused = False
+        self.clock.resume()
+
+    def seek(self, secs, index=None):
+        offset = skip = 0
+        if secs and index:
+            offset, secs = index.locate(secs)
+        elif secs:
+            # Index still building: let mpg123 skip whole frames
+            try:
+                skip = int(secs * MP3(self.path).info.sample_rate / 1152)
+            except:
+                secs = 0.0
+        self.restart(self.decoder(self.path, offset, skip))
+        self.clock.start(secs, paused=self.paused)
+        return secs
+
+    def set_volume(self, level):
+        self.volume = level
+        if self.channel:
+            self.channel.set_volume(level)
+
+    def queue_next(self, path):
+        self.next_path = path
+
+    def stop(self):
+        PlaybackEngine.stop(self)
+        with self.lock:
+            self.gen += 1
+            if self.channel:
+                self.channel.stop()
+
+    def poll(self):
+        events = []
+        while True:
+            try:
+                gen, ev, path = self.events.get_nowait()
+            except queue.Empty:
+                return events
+            if gen != self.gen:
+                continue
+            if ev == "advanced":
+                self.path, self.next_path = path, None
+                self.clock.start(0.0)
+            else:
+                self.path = None
+            events.append(ev)
+
+
+# Engines that need mpg123 are only offered when it is installed, a saved choice falls back to pygame
+ENGINES = {"pygame": PygameEngine, "dummy": DummyEngine}
+if shutil.which("mpg123"):
+    ENGINES["mpg123"] = Mpg123Engine
+    if np is not None:
+        ENGINES["dsp"] = DspEngine
+
+
+class Prefetcher:
+    """Warms the next tracks in the queue so a busy SD card or a spun-down USB disk can't
+    stall a track start.
+
+    Upcoming files get posix_fadvise(WILLNEED) and their first chunk read on a worker thread.
+    With stage_mb set they are also copied into a size-capped RAM dir, evicted LRU, and the
+    engine plays the copy. A start counts as a prevented stall when the first small read of the
+    warm-up took longer than STALL_SECS (a waking disk or a busy card, not plain throughput),
+    i.e. playback would have waited that long on the disk.
+    """
+
+    HEAD_BYTES = 4 * 1024 * 1024
+    PROBE_BYTES = 64 * 1024
+    STALL_SECS = 0.15
+
+    def __init__(self, stage_dir="/dev/shm/pidice", stage_mb=0):
+        self.stage_dir = stage_dir
+        self.stage_budget = stage_mb * 1024 * 1024
+        self.staged = OrderedDict()
+        self.staged_bytes = 0
+        self.warm = {}
+        self.wanted = []
+        self.current = None
+        # staged is reordered by local() on the Tk thread while the worker adds and evicts
+        self.lock = threading.Lock()
+        self.jobs = queue.SimpleQueue()
+        self.hits = self.misses = self.prevented = 0
+        if self.stage_budget:
+            shutil.rmtree(self.stage_dir, ignore_errors=True)
+            os.makedirs(self.stage_dir, exist_ok=True)
+        threading.Thread(target=self.run, daemon=True, name="prefetch").start()
+
+    def want(self, paths):
+        """Called from the Tk thread with the next few queue entries, nearest first."""
+        self.wanted = list(paths)
+        self.jobs.put(self.wanted)
+
+    def run(self):
+        while True:
+            paths = self.jobs.get()
+            with self.lock:
+                # Tracks that dropped out of the upcoming list without playing are forgotten
+                self.warm = {p: slow for p, slow in self.warm.items() if p in paths}
+            for path in paths:
+                if paths is not self.wanted:
+                    break  # the queue moved on, a newer job is waiting
+                if path not in self.warm:
+                    self.warm_up(path)
+                if self.stage_budget and path not in self.staged:
+                    self.stage(path)
+
+    def warm_up(self, path):
+        try:
+            with open(path, "rb") as f:
+                start = time.monotonic()
+                f.read(self.PROBE_BYTES)
+                slow = time.monotonic() - start > self.STALL_SECS
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                f.read(self.HEAD_BYTES - self.PROBE_BYTES)
+        except OSError:
+            return
+        with self.lock:
+            self.warm[path] = slow
+
+    def stage(self, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        if size > self.stage_budget:
+            return
+        with self.lock:
+            # The playing copy stays too: the engine reopens engine.path on every seek
+            keep = set(self.wanted) | {self.current}
+            victims, used = [], self.staged_bytes
+            for old, (_, old_size) in self.staged.items():
+                if used + size <= self.stage_budget:
+                    break
+                if old not in keep:
+                    victims.append(old)
+                    used -= old_size
+            if used + size > self.stage_budget:
+                return  # everything left is playing or upcoming
+            for old in victims:
+                copy, old_size = self.staged.pop(old)
+                self.staged_bytes -= old_size
+                try:
+                    os.unlink(copy)
+                except OSError:
+                    pass
+        copy = os.path.join(self.stage_dir, f"{abs(hash(path)):x}{os.path.splitext(path)[1]}")
+        try:
+            shutil.copyfile(path, copy + ".part")
+            os.replace(copy + ".part", copy)
+        except OSError:
+            return
+        with self.lock:
+            self.staged[path] = (copy, size)
+            self.staged_bytes += size
+
+    def local(self, path):
+        """The RAM copy of `path` when staged, otherwise `path` itself."""
+        with self.lock:
+            entry = self.staged.get(path)
+            if entry:
+                self.staged.move_to_end(path)
+                return entry[0]
+        return path
+
+    def started(self, path):
+        with self.lock:
+            self.current = path
+            if path in self.staged or path in self.warm:
+                self.hits += 1
+                if self.warm.pop(path, False):
+                    self.prevented += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "prevented_stalls": self.prevented,
+                    "staged": len(self.staged), "staged_bytes": self.staged_bytes}
+
+
+class PlayHistory:
+    """Play events in an append-only binary log, folded into counts kept in memory.
+
+    Each event is a fixed 13 byte record (kind, track id, unix time, position). A track id is
+    bound to its path once per log by a DEFINE record followed by the UTF-8 path. Records are
+    buffered and reach the SD card at most every FLUSH_SECS. Compaction folds the log into
+    history.json and starts a new log segment. The segment number in the log header tells a
+    log that was already folded (power cut between the two writes) from a live one.
+    """
+
+    REC = struct.Struct("<BIIf")
+    HEADER, DEFINE, START, SKIP, COMPLETE = range(5)
+    FLUSH_SECS = 300
+    COMPACT_BYTES = 256 * 1024
+    RECENT = 50
+    TOP_K = 50
+    MIN_PLAY_SECS = 30  # a skip after this long still counts as a play
+
+    def __init__(self, log_path, agg_path):
+        self.log_path, self.agg_path = log_path, agg_path
+        self.plays, self.skips = {}, {}
+        self.recent = deque(maxlen=self.RECENT)
+        self.top = []
+        self.segment = 0
+        self.ids = {}
+        self.buf = bytearray()
+        self.last_flush = time.monotonic()
+        try:
+            with open(agg_path) as f:
+                d = json.load(f)
+            self.plays, self.skips = d.get("plays", {}), d.get("skips", {})
+            self.recent.extend(d.get("recent", []))
+            self.segment = d.get("segment", 0)
+        except (OSError, ValueError):
+            pass
+        self.replay()
+        self.top = sorted(self.plays, key=self.plays.get, reverse=True)[:self.TOP_K]
+        self.compact()
+
+    def replay(self):
+        try:
+            with open(self.log_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return
+        paths, pos, size = {}, 0, self.REC.size
+        while pos + size <= len(data):
+            kind, tid, ts, secs = self.REC.unpack_from(data, pos)
+            pos += size
+            if kind == self.HEADER:
+                if tid < self.segment:
+                    return  # already folded into the aggregates
+            elif kind == self.DEFINE:
+                if pos + ts > len(data): break
+                paths[tid] = data[pos:pos + ts].decode("utf-8", "replace")
+                pos += ts
+            elif tid in paths:
+                self.apply(kind, paths[tid], secs)
+        # A torn tail record from a power cut is simply dropped
+
+    def apply(self, kind, path, secs):
+        if kind == self.START:
+            if path in self.recent:
+                self.recent.remove(path)
+            self.recent.appendleft(path)
+        elif kind == self.COMPLETE or secs >= self.MIN_PLAY_SECS:
+            self.plays[path] = self.plays.get(path, 0) + 1
+            return True
+        else:
+            self.skips[path] = self.skips.get(path, 0) + 1
+
+    def bump_top(self, path):
+        """Keeps `top` sorted by plays without re-sorting the whole library."""
+        n = self.plays[path]
+        if path in self.top:
+            self.top.remove(path)
+        elif len(self.top) >= self.TOP_K:
+            if n <= self.plays[self.top[-1]]: return
+            self.top.pop()
+        i = len(self.top)
+        while i and self.plays[self.top[i - 1]] < n:
+            i -= 1
+        self.top.insert(i, path)
+
+    def record(self, kind, path, secs=0.0):
+        tid = self.ids.get(path)
+        if tid is None:
+            tid = self.ids[path] = len(self.ids)
+            raw = path.encode("utf-8")
+            self.buf += self.REC.pack(self.DEFINE, tid, len(raw), 0.0) + raw
+        self.buf += self.REC.pack(kind, tid, int(time.time()), secs)
+        if self.apply(kind, path, secs):
+            self.bump_top(path)
+        if time.monotonic() - self.last_flush > self.FLUSH_SECS:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buf: return
+        try:
+            with open(self.log_path, "ab") as f:
+                f.write(self.buf)
+                size = f.tell()
+        except OSError as e:
+            print(f"History Error: {e}")
+            return
+        self.buf.clear()
+        if size > self.COMPACT_BYTES:
+            self.compact()
+
+    def compact(self):
+        """Folds everything into the aggregate file and starts a fresh log segment."""
+        self.segment += 1
+        try:
+            tmp = self.agg_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"segment": self.segment, "plays": self.plays, "skips": self.skips,
+                           "recent": list(self.recent)}, f)
+            os.replace(tmp, self.agg_path)
+            with open(self.log_path, "wb") as f:
+                f.write(self.REC.pack(self.HEADER, self.segment, int(time.time()), 0.0))
+        except OSError as e:
+            print(f"History Error: {e}")
+        self.ids.clear()
+        self.buf.clear()
+
+    def most_played(self):
+        return [(p, self.plays[p]) for p in self.top]
+
+
+class StallWatchdog:
+    """Logs the Tk thread's stack when the main loop hasn't ticked within `threshold` seconds."""
+
+    def __init__(self, app, log_path, threshold=2.0):
+        self.app = app
+        self.threshold = threshold
+        self.main_ident = threading.main_thread().ident
+        self.last_tick = time.monotonic()
+        self.stalled_since = None
+        self.log = logging.getLogger("pidice.stalls")
+        self.log.propagate = False
+        if not self.log.handlers:
+            handler = RotatingFileHandler(log_path, maxBytes=256 * 1024, backupCount=3)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            self.log.addHandler(handler)
+            self.log.setLevel(logging.INFO)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name="stall-watchdog").start()
+
+    def tick(self):
+        """Called from the Tk loop."""
+        self.last_tick = time.monotonic()
+        if self.stalled_since is not None:
+            self.log.info("UI recovered after %.1fs", self.last_tick - self.stalled_since)
+            self.stalled_since = None
+
+    def run(self):
+        while True:
+            time.sleep(self.threshold / 4)
+            late = time.monotonic() - self.last_tick
+            if late > self.threshold and self.stalled_since is None:
+                self.stalled_since = self.last_tick
+                self.capture(late)
+
+    def capture(self, late):
+        frame = sys._current_frames().get(self.main_ident)
+        stack = "".join(traceback.format_stack(frame)) if frame else "(main thread gone)"
+        key, when = self.app.last_input
+        since = f"{key} {time.time() - when:.1f}s ago" if key else "none"
+        self.log.warning("UI stalled %.1fs | screen=%s | last input=%s\n%s",
+                         late, self.app.current_screen, since, stack)
+
+
+# --- Control API ---
+
+class ControlServer:
+    """JSON-lines control socket on its own asyncio thread.
+
+    Each request is one line like {"id": 1, "cmd": "seek", "pos": 90}. Player commands are
+    handed to the Tk thread through App.post, library queries run in an executor, and
+    {"cmd": "subscribe"} turns the connection into a push feed of state events.
+    """
+
+    LIBRARY_CMDS = ("playlists", "songs")
+
+    def __init__(self, app, path=CONTROL_SOCKET):
+        self.app = app
+        self.path = path
+        self.loop = None
+        self.server = None
+        self.inode = None
+        self.clients = {}
+        self.subscribers = set()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name="control-api").start()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.server = self.loop.run_until_complete(asyncio.start_unix_server(self.handle, path=self.path))
+            self.inode = os.stat(self.path).st_ino
+            self.loop.run_forever()
+        except Exception as e:
+            print(f"Control API Error: {e}")
+
+    def stop(self):
+        if self.loop:
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop)
+
+    async def shutdown(self):
+        """Closes the listener and every open connection, removes the socket, then the loop."""
+        if self.server:
+            self.server.close()
+        for w in list(self.clients):
+            w.close()
+        # Let the handlers see EOF and finish before the loop goes away under them
+        if self.clients:
+            await asyncio.wait(list(self.clients.values()), timeout=1)
+        try:
+            # A server started right after this one may already own the path
+            if os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+        self.loop.stop()
+
+    async def handle(self, reader, writer):
+        self.clients[writer] = asyncio.current_task()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                msg = {}
+                try:
+                    parsed = json.loads(line)
+                    if not isinstance(parsed, dict):
+                        raise ValueError("request must be a JSON object")
+                    msg = parsed
+                    reply = {"id": msg.get("id"), "ok": True, "result": await self.dispatch(msg, writer)}
+                except Exception as e:
+                    reply = {"id": msg.get("id"), "ok": False, "error": str(e)}
+                writer.write((json.dumps(reply) + "\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.pop(writer, None)
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def dispatch(self, msg, writer):
+        cmd = msg.get("cmd")
+        if cmd == "subscribe":
+            self.subscribers.add(writer)
+            return "subscribed"
+        if cmd in self.LIBRARY_CMDS:
+            return await self.loop.run_in_executor(None, self.app.query_library, cmd, msg)
+        fut = self.loop.create_future()
+
+        def done(result, error=None):
+            if error is None:
+                self.loop.call_soon_threadsafe(fut.set_result, result)
+            else:
+                self.loop.call_soon_threadsafe(fut.set_exception, error)
+
+        self.app.post(self.app.run_command, cmd, msg, done)
+        return await fut
+
+    def publish(self, event, **data):
+        """Thread-safe, called from the Tk thread whenever player state changes."""
+        if self.loop and self.subscribers:
+            line = (json.dumps(dict(data, event=event)) + "\n").encode()
+            self.loop.call_soon_threadsafe(self.broadcast, line)
+
+    def broadcast(self, line):
+        for w in list(self.subscribers):
+            # Drop subscribers that stopped reading instead of buffering for them forever
+            if w.is_closing() or w.transport.get_write_buffer_size() > 65536:
+                self.subscribers.discard(w)
+                w.close()
+            else:
+                w.write(line)
+
+
 # --- Custom UI Components ---
 
 class CustomPopup(tk.Toplevel):
@@ -70,8 +1812,14 @@ class TopBar(tk.Frame):
         self.lbl_stats = tk.Label(self, font=("Courier", 10, "bold"), bg=FG, fg=BG)
         self.lbl_stats.pack(side="right", padx=20)
 
+        self.after_id = None
         self.update_bar()
 
+    def suspend(self):
+        if self.after_id:
+            self.after_cancel(self.after_id)
+            self.after_id = None
+
     def update_bar(self):
         try:
             tz = zoneinfo.ZoneInfo("Europe/Stockholm")
@@ -91,12 +1839,15 @@ class TopBar(tk.Frame):
         except:
             self.lbl_stats.config(text="STATS ERROR")
 
-        self.after(1000, self.update_bar)
+        self.after_id = self.after(1000, self.update_bar)
 
 
 # --- Screens ---
 
 class MP3Menu(tk.Frame):
+    # History playlists, listed after the folders so startup still lands on the first folder
+    VIRTUAL = {":recent": "RECENTLY PLAYED", ":top": "MOST PLAYED"}
+
     def __init__(self, parent, controller):
         super().__init__(parent, bg=BG)
         self.ctrl = controller
@@ -116,10 +1867,16 @@ class MP3Menu(tk.Frame):
         self.MAX_CHARS = 28
         self.TICK_SPEED = 150
         self.PAUSE_TICKS = 13
+        self.flash_text = ""
+        self.flash_ticks = 0
 
-    def refresh(self):
+    def suspend(self):
         if self.after_id:
             self.after_cancel(self.after_id)
+            self.after_id = None
+
+    def refresh(self):
+        self.suspend()
         for widget in self.winfo_children():
             widget.destroy()
         if self.view_mode == "playlists":
@@ -128,11 +1885,13 @@ class MP3Menu(tk.Frame):
             self.show_songs_view()
 
     def show_playlists(self):
-        path = "/home/dietpi/pidice/MP3s/"
-        try:
-            self.playlists = natural_sort([d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))])
-        except:
-            self.playlists = []
+        self.ctrl.img_cache.pin("songs", [])
+        # Entries are absolute paths kept current by the library watcher, no listdir here
+        self.playlists = self.ctrl.library_folders + list(self.VIRTUAL)
+        if self.sel_folder in self.playlists:
+            self.cur_idx = self.playlists.index(self.sel_folder)
+        elif self.playlists:
+            self.cur_idx %= len(self.playlists)
         self.canvas = tk.Canvas(self, bg=BG, highlightthickness=0, width=self.ctrl.screen_w, height=self.ctrl.screen_h)
         self.canvas.pack(fill="both", expand=True)
         self.draw_coverflow()
@@ -142,39 +1901,48 @@ class MP3Menu(tk.Frame):
         if not self.playlists: return
         cx, cy = self.ctrl.screen_w // 2, (self.ctrl.screen_h // 2) - 60
         indices = [(self.cur_idx - 1) % len(self.playlists), self.cur_idx, (self.cur_idx + 1) % len(self.playlists)]
+        shown = []
         for i, idx in enumerate(indices):
             folder = self.playlists[idx]
             sf = self.ctrl.screen_w / 800
             size = (int(300 * sf), int(300 * sf)) if i == 1 else (int(200 * sf), int(200 * sf))
             off = int(250 * sf)
             x = cx if i == 1 else (cx - off if i == 0 else cx + off)
-            p = os.path.join("/home/dietpi/pidice/MP3s/", folder, "cover.png")
-
-            cache_key = (p, size)
-            if cache_key in self.ctrl.img_cache:
-                photo = self.ctrl.img_cache[cache_key]
-            else:
-                try:
-                    img = Image.open(p) if os.path.exists(p) else Image.new('RGB', size, color='#111')
-                    img = img.resize(size, Image.Resampling.LANCZOS)
-                    photo = ImageTk.PhotoImage(img)
-                    self.ctrl.img_cache[cache_key] = photo
-                except:
-                    continue
+            p = os.path.join(self.cover_folder(folder), "cover.png")
+            try:
+                photo = self.ctrl.img_cache.get(p, size)
+            except:
+                continue
+            shown.append((p, size))
             self.canvas.create_image(x, cy, image=photo)
-        self.canvas.create_text(cx, cy + int(210 * sf), text=self.playlists[self.cur_idx].upper(),
+        self.ctrl.img_cache.pin("coverflow", shown)
+        folder = self.playlists[self.cur_idx]
+        name = self.VIRTUAL.get(folder) or os.path.basename(folder)
+        if is_m3u(name):
+            name = "♫ " + os.path.splitext(name)[0]
+        self.canvas.create_text(cx, cy + int(210 * sf), text=name.upper(),
                                 font=("Courier", int(20 * sf), "bold"), fill=FG)
 
+    def virtual_tracks(self, key):
+        """Absolute paths straight from the in-memory history, no scan."""
+        h = self.ctrl.history
+        return list(h.recent) if key == ":recent" else list(h.top)
+
+    def cover_folder(self, folder):
+        if folder not in self.VIRTUAL:
+            return folder
+        tracks = self.virtual_tracks(folder)
+        return os.path.dirname(tracks[0]) if tracks else folder
+
     def show_songs_view(self):
         self.grid_columnconfigure(0, weight=1)
         self.grid_columnconfigure(1, weight=1)
         self.grid_rowconfigure(0, weight=1)
-        cover_p = os.path.join("/home/dietpi/pidice/MP3s/", self.sel_folder, "cover.png")
+        cover_p = os.path.join(self.cover_folder(self.sel_folder), "cover.png")
         size = (300, 300)
         try:
-            img = Image.open(cover_p) if os.path.exists(cover_p) else Image.new('RGB', size, color='#111')
-            img = img.resize(size, Image.Resampling.LANCZOS)
-            self.song_view_photo = ImageTk.PhotoImage(img)
+            self.song_view_photo = self.ctrl.img_cache.get(cover_p, size)
+            self.ctrl.img_cache.pin("songs", [(cover_p, size)])
             tk.Label(self, image=self.song_view_photo, bg=BG).grid(row=0, column=0, padx=20)
         except:
             pass
@@ -189,11 +1957,7 @@ class MP3Menu(tk.Frame):
                                     anchor="w")
         self.p_name_lbl.grid(row=1, column=0, pady=(0, 10), sticky="ew")
 
-        path = os.path.join("/home/dietpi/pidice/MP3s/", self.sel_folder)
-        try:
-            self.songs = natural_sort([f for f in os.listdir(path) if f.endswith(".mp3")])
-        except:
-            self.songs = []
+        self.load_songs()
 
         self.btns = []
         for i in range(self.visible_count):
@@ -204,13 +1968,48 @@ class MP3Menu(tk.Frame):
         self.update_list_display()
         self.scroll_loop()
 
+    def load_songs(self):
+        if self.sel_folder in self.VIRTUAL:
+            self.songs = self.virtual_tracks(self.sel_folder)
+            self.cur_idx = min(self.cur_idx, max(0, len(self.songs) - 1))
+            return
+        try:
+            self.songs = natural_sort([f for f in os.listdir(self.sel_folder) if f.endswith(".mp3")])
+        except:
+            self.songs = []
+        if self.songs:
+            self.cur_idx = min(self.cur_idx, len(self.songs) - 1)
+
+    def library_changed(self, added, removed, touched):
+        """Pushed by the watcher: patch the coverflow or song list in place."""
+        if self.view_mode == "songs":
+            if self.sel_folder in removed:
+                self.view_mode = "playlists"
+                self.refresh()
+            elif self.sel_folder in touched:
+                self.load_songs()
+                self.update_list_display()
+        elif self.canvas and (added or removed or touched):
+            # App swaps in a new list, so the old one still says what was centred
+            current = self.playlists[self.cur_idx] if self.playlists else None
+            had_folders = len(self.playlists) > len(self.VIRTUAL)
+            self.playlists = self.ctrl.library_folders + list(self.VIRTUAL)
+            if not had_folders:
+                # First batch after an empty start: land on the first folder like startup does
+                self.cur_idx = 0
+            elif current in self.playlists:
+                self.cur_idx = self.playlists.index(current)
+            elif self.playlists:
+                self.cur_idx %= len(self.playlists)
+            self.draw_coverflow()
+
     def update_list_display(self):
         start_idx = max(0, min(self.cur_idx - self.visible_count // 2, len(self.songs) - self.visible_count))
         self.s_scroll_pos, self.scroll_dir, self.wait_ticks = 0, 1, self.PAUSE_TICKS
         for i in range(self.visible_count):
             actual_idx = start_idx + i
             if actual_idx < len(self.songs):
-                song_name = self.songs[actual_idx].replace(".mp3", "").upper()
+                song_name = os.path.basename(self.songs[actual_idx]).replace(".mp3", "").upper()
                 if actual_idx == self.cur_idx:
                     self.btns[i].config(text=song_name[:self.MAX_CHARS], bg=FG, fg=BG)
                 else:
@@ -219,15 +2018,18 @@ class MP3Menu(tk.Frame):
                 self.btns[i].config(text="", bg=BG)
 
     def scroll_loop(self):
-        p_full = self.sel_folder.upper()
-        if len(p_full) > 22:
+        p_full = self.VIRTUAL.get(self.sel_folder) or os.path.basename(self.sel_folder).upper()
+        if self.flash_ticks > 0:
+            self.flash_ticks -= 1
+            self.p_name_lbl.config(text=self.flash_text)
+        elif len(p_full) > 22:
             self.p_scroll_pos = (self.p_scroll_pos + 1) % (len(p_full) + 5)
             start = max(0, self.p_scroll_pos)
             self.p_name_lbl.config(text=p_full[start:start + 22])
         else:
             self.p_name_lbl.config(text=p_full)
         if self.songs:
-            s_full = self.songs[self.cur_idx].replace(".mp3", "").upper()
+            s_full = os.path.basename(self.songs[self.cur_idx]).replace(".mp3", "").upper()
             if len(s_full) > self.MAX_CHARS:
                 if self.wait_ticks > 0:
                     self.wait_ticks -= 1
@@ -264,15 +2066,25 @@ class MP3Menu(tk.Frame):
                 self.update_list_display()
 
     def select(self):
-        if self.view_mode == "playlists" and self.playlists:
+        if self.view_mode == "playlists" and self.playlists and is_m3u(self.playlists[self.cur_idx]):
+            self.ctrl.load_m3u(self.playlists[self.cur_idx])
+        elif self.view_mode == "playlists" and self.playlists:
             self.sel_folder = self.playlists[self.cur_idx]
             self.view_mode = "songs"
             self.cur_idx = 0
             self.refresh()
         elif self.view_mode == "songs" and self.songs:
-            path = os.path.join("/home/dietpi/pidice/MP3s/", self.sel_folder)
-            # Match the App.play_track(playlist, index, path, increment) signature
-            self.ctrl.play_track(self.songs, self.cur_idx, path, increment=False)
+            # Match the App.play_track(playlist, index, path) signature. History entries are
+            # absolute, so os.path.join drops the virtual folder key for them.
+            self.ctrl.play_track(self.songs, self.cur_idx, self.sel_folder)
+
+    def queue_selected(self, play_next=False):
+        """Adds the highlighted song to the play queue without replacing it."""
+        if self.view_mode != "songs" or not self.songs: return
+        path = os.path.join(self.sel_folder, self.songs[self.cur_idx])
+        self.ctrl.enqueue([path], play_next=play_next)
+        self.flash_text = "+ PLAY NEXT" if play_next else "+ QUEUED"
+        self.flash_ticks = 8
 
 
 class NowPlaying(tk.Frame):
@@ -280,6 +2092,11 @@ class NowPlaying(tk.Frame):
         super().__init__(parent, bg=BG)
         self.ctrl = controller
         self.cur_idx = 1
+        self.ui_after = None
+        self.scrub_pos = None
+        self.scrub_ticks = 0
+        self.scrub_after = None
+        self.last_px = self.last_sec = -1
 
         self.grid_columnconfigure(0, weight=0)
         self.grid_columnconfigure(1, weight=1)
@@ -350,20 +2167,21 @@ class NowPlaying(tk.Frame):
         self.btn_data[self.cur_idx]["cmd"]()
 
     def refresh(self):
-        if not self.ctrl.playlist: return
-        song_file = self.ctrl.playlist[self.ctrl.idx]
+        if not self.ctrl.track_file: return
+        song_file = os.path.basename(self.ctrl.track_file)
         self.title.config(text=song_file.replace(".mp3", "").upper())
 
-        img_p = os.path.join(self.ctrl.path, "cover.png")
+        img_p = os.path.join(os.path.dirname(self.ctrl.track_file), "cover.png")
         if os.path.exists(img_p):
             try:
-                img = Image.open(img_p).resize((360, 360), Image.Resampling.LANCZOS)
-                photo = ImageTk.PhotoImage(img)
+                photo = self.ctrl.img_cache.get(img_p, (360, 360))
+                self.ctrl.img_cache.pin("NowPlaying", [(img_p, (360, 360))])
                 self.cover_label.config(image=photo)
                 self.cover_label.image = photo
             except:
                 pass
 
+        self.last_px = self.last_sec = -1
         self.update_vol_bar()
         self.update_visuals()
         self.update_ui_loop()
@@ -379,39 +2197,62 @@ class NowPlaying(tk.Frame):
             else:
                 btn.config(bg=BG, fg=FG)
 
+    def suspend(self):
+        if self.ui_after:
+            self.after_cancel(self.ui_after)
+            self.ui_after = None
+
     def update_ui_loop(self):
-        if self.ctrl.current_screen != "NowPlaying": return
-        if pygame.mixer.music.get_busy() or self.ctrl.is_paused:
-            try:
-                path = os.path.join(self.ctrl.path, self.ctrl.playlist[self.ctrl.idx])
-                total = MP3(path).info.length
-                curr = pygame.mixer.music.get_pos() / 1000.0
-                if curr < 0: curr = 0
-                self.p_can.coords(self.p_bar, 0, 0, min(1.0, curr / total) * 320, 12)
-                self.t_lbl.config(
-                    text=f"{int(curr // 60)}:{int(curr % 60):02d}/{int(total // 60)}:{int(total % 60):02d}")
-            except:
-                pass
-        self.after(1000, self.update_ui_loop)
+        self.suspend()
+        if self.ctrl.current_screen != "NowPlaying" or self.ctrl.low_power: return
+        self.draw_progress()
+        # Position comes from the clock, so redrawing at the frame cap costs no mixer or file polling
+        self.ui_after = self.after(1000 // max(1, self.ctrl.fps_cap), self.update_ui_loop)
+
+    def draw_progress(self):
+        total = self.ctrl.track_length
+        if not total: return
+        curr = self.scrub_pos if self.scrub_pos is not None else self.ctrl.engine.position()
+        curr = max(0.0, min(curr, total))
+        px = int(curr / total * 320)
+        if px != self.last_px:
+            self.p_can.coords(self.p_bar, 0, 0, px, 12)
+            self.last_px = px
+        if int(curr) != self.last_sec:
+            self.t_lbl.config(text=f"{fmt_time(curr)}/{fmt_time(total)}")
+            self.last_sec = int(curr)
+
+    def scrub(self, d):
+        """Called while Left/Right is held: moves a preview position, seeks once the key is let go."""
+        if not self.ctrl.track_file or not self.ctrl.track_length: return
+        if self.scrub_pos is None:
+            self.scrub_pos, self.scrub_ticks = self.ctrl.engine.position(), 0
+        self.scrub_ticks += 1
+        step = 5 if self.scrub_ticks < 10 else (15 if self.scrub_ticks < 30 else 60)
+        self.scrub_pos = max(0.0, min(self.scrub_pos + d * step, self.ctrl.track_length - 1))
+        self.draw_progress()
+        if self.scrub_after:
+            self.after_cancel(self.scrub_after)
+        self.scrub_after = self.after(600, self.commit_scrub)
+
+    def commit_scrub(self):
+        self.scrub_after = None
+        if self.scrub_pos is not None:
+            self.ctrl.seek(self.scrub_pos)
+            self.scrub_pos = None
+            self.draw_progress()
 
     def toggle(self):
-        if self.ctrl.is_paused:
-            pygame.mixer.music.unpause(); self.ctrl.is_paused = False
-        else:
-            pygame.mixer.music.pause(); self.ctrl.is_paused = True
-        self.update_visuals()
+        self.ctrl.toggle_pause()
 
     def toggle_repeat(self):
-        self.ctrl.repeat_state = not self.ctrl.repeat_state
-        self.update_visuals()
+        self.ctrl.set_repeat(not self.ctrl.repeat_state)
 
     def next(self):
-        n = (self.ctrl.idx + 1) % len(self.ctrl.playlist)
-        self.ctrl.play_track(self.ctrl.playlist, n, self.ctrl.path)
+        self.ctrl.skip(1)
 
     def prev(self):
-        n = (self.ctrl.idx - 1) % len(self.ctrl.playlist)
-        self.ctrl.play_track(self.ctrl.playlist, n, self.ctrl.path)
+        self.ctrl.skip(-1)
 
 
 class SettingsMenu(tk.Frame):
@@ -450,12 +2291,39 @@ class SettingsMenu(tk.Frame):
         for d in devices:
             label = f"● {d}" if d == current else f"○ {d}"
             opts.append((label, lambda dev=d: self.select_audio_device(dev)))
+        opts.append((f"ENGINE: {self.ctrl.engine.name.upper()}", self.cycle_engine))
+        if "dsp" in ENGINES:
+            opts.append((f"EQ: {self.ctrl.eq_preset}", self.show_eq))
         opts.append(("⬅ BACK", self.show_main_settings))
         self.build_btns(opts)
 
+    def show_eq(self):
+        self.clear_menu()
+        opts = []
+        for name in Equalizer.PRESETS:
+            label = f"● {name}" if name == self.ctrl.eq_preset else f"○ {name}"
+            opts.append((label, lambda p=name: self.select_eq(p)))
+        if isinstance(self.ctrl.engine, DspEngine):
+            eq = self.ctrl.engine.eq
+            opts.append((f"DSP LOAD: {'BYPASSED' if eq.bypassed else f'{eq.load:.0%}'}", lambda: None))
+        opts.append(("⬅ BACK", self.show_audio))
+        self.build_btns(opts)
+
+    def select_eq(self, preset):
+        self.ctrl.set_eq(preset)
+        self.show_eq()
+
     def select_audio_device(self, device):
         self.ctrl.audio_output = device
         self.ctrl.save_settings()
+        self.ctrl.reopen_output()
+        self.show_audio()
+
+    def cycle_engine(self):
+        # The dummy engine is for tests and benchmarks, not something to pick on the device
+        names = [n for n in ("pygame", "mpg123", "dsp") if n in ENGINES]
+        cur = names.index(self.ctrl.engine.name) if self.ctrl.engine.name in names else -1
+        self.ctrl.set_engine(names[(cur + 1) % len(names)])
         self.show_audio()
 
     def show_network_bt(self):
@@ -487,8 +2355,9 @@ class SettingsMenu(tk.Frame):
         s_opts = self.ctrl.sleep_opts
         opts = [
             (f"SLEEP: {s_opts[s_idx]}", self.cycle_sl),
-            ("REBOOT", lambda: os.system("sudo reboot")),
-            ("SHUTDOWN", lambda: os.system("sudo poweroff")),
+            (f"CONTROL API: {'ON' if self.ctrl.control_api else 'OFF'}", self.toggle_api),
+            ("REBOOT", lambda: self.power("reboot")),
+            ("SHUTDOWN", lambda: self.power("poweroff")),
             ("⬅ BACK", self.show_main_settings)
         ]
         self.build_btns(opts)
@@ -504,7 +2373,16 @@ class SettingsMenu(tk.Frame):
 
     def cycle_sl(self):
         self.ctrl.sleep_idx = (self.ctrl.sleep_idx + 1) % len(self.ctrl.sleep_opts)
-        self.ctrl.save_settings(); self.show_system()
+        self.ctrl.save_settings(); self.ctrl.reset_sleep_timer(); self.show_system()
+
+    def power(self, cmd):
+        # mainloop never returns from here, so the exit-time flush in __main__ won't run
+        self.ctrl.history.flush()
+        os.system(f"sudo {cmd}")
+
+    def toggle_api(self):
+        self.ctrl.set_control_api(not self.ctrl.control_api)
+        self.show_system()
 
     def move(self, d, is_vertical=True):
         if is_vertical and self.btns:
@@ -702,13 +2580,6 @@ class App(tk.Tk):
     def __init__(self):
         super().__init__()
 
-        try:
-            pygame.mixer.pre_init(44100, -16, 2, 4096)
-            pygame.init()
-            pygame.mixer.music.set_endevent(MUSIC_END)
-        except Exception as e:
-            print(f"Mixer Init Error: {e}")
-
         self.title("PiDice MP3")
         self.attributes('-fullscreen', True)
         self.config(cursor="none", bg=BG)
@@ -716,17 +2587,43 @@ class App(tk.Tk):
         self.update_idletasks()
         self.screen_w = self.winfo_screenwidth()
         self.screen_h = self.winfo_screenheight()
-        self.img_cache = {}
+        self.img_cache_mb = 24
 
         self.vol_presets = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
         self.vol_idx = 10
         self.vol_level = self.vol_presets[self.vol_idx] / 100.0
 
-        self.playlist, self.idx, self.path = [], 0, ""
+        self.library = Library()
+        self.queue = PlayQueue()
+        self.track_file = None
+        self.m3u_gen = 0
+        self.library_roots = [MUSIC_ROOT]
+        self.auto_mounts = True
+        self.prefetch_depth = 2
+        self.stage_mb = 0
+        self.library_folders = []
+        self.engine_name = "pygame"
+        self.engine = None
+        self.eq_preset = "FLAT"
+        self.dsp_budget = 0.25
+        self.primed_slot = -1
+        self.track_length = 0
+        self.frame_index = None
+        self.frame_index_cache = {}
+        self._released = None
+        self._tap = None
         self.repeat_state = False
         self.is_paused = False
         self.current_screen = None
         self.audio_output = "3.5mm Jack"
+        self.audio_profiles = {}
+        self.output_devices = {"3.5mm Jack": None}
+        self.tuner_ticks = 0
+        self.control_api = False
+        self.control = None
+        self.stall_threshold = 2.0
+        self.last_input = (None, 0)
+        self.main_calls = queue.SimpleQueue()
         self.fps_cap = 30
         self.resolution_mode = "800x480"
 
@@ -737,9 +2634,31 @@ class App(tk.Tk):
         self.sleep_opts = ["OFF", "15S", "30S", "1M", "2M"]
         self.last_input_time = time.time()
         self.screen_on = True
+        self.low_power = False
+        self.sleep_after = None
+        self.backlight = next(iter(glob.glob("/sys/class/backlight/*/bl_power")), None)
 
         self.settings_file = os.path.join(os.path.dirname(__file__), "settings.json")
         self.load_settings()
+        self.vol_level = self.vol_presets[self.vol_idx] / 100.0
+        self.img_cache = ImageCache(self.img_cache_mb)
+        self.tuner = AudioTuner(self.audio_profiles)
+        self.watchdog = StallWatchdog(self, os.path.join(os.path.dirname(__file__), "stalls.log"),
+                                      self.stall_threshold)
+        self.watchdog.start()
+        self.watcher = LibraryWatcher(self, self.library_roots, self.auto_mounts)
+        self.watcher.start()
+        self.prefetcher = Prefetcher(stage_mb=self.stage_mb)
+        here = os.path.dirname(__file__)
+        self.history = PlayHistory(os.path.join(here, "history.log"), os.path.join(here, "history.json"))
+        self.played = None
+
+        self.engine = self.make_engine(self.engine_name)
+        try:
+            self.get_system_outputs()
+            self.open_output()
+        except Exception as e:
+            print(f"Audio Init Error: {e}")
 
         from __main__ import TopBar
         self.top_bar = TopBar(self, self)
@@ -759,11 +2678,14 @@ class App(tk.Tk):
 
         self.setup_gpio()
         self.bind_all("<Key>", self.handle_keys)
-        self.check_pygame_events()
-        self.check_sleep_timer()
+        self.bind_all("<KeyRelease>", self.handle_key_release)
+        self.check_audio_events()
+        self.reset_sleep_timer()
 
         self.set_screen_state(True)
         self.show_frame("MP3Menu")
+        if self.control_api:
+            self.set_control_api(True)
 
     def get_bt_devices(self):
         try:
@@ -785,11 +2707,69 @@ class App(tk.Tk):
             for line in result.stdout.split('\n'):
                 if "card" in line and "device" in line:
                     name = line.split('[')[1].split(']')[0] if '[' in line else "Hardware Output"
+                    # "card 1: Headphones [bcm2835 Headphones], device 0: ..." -> plughw:CARD=Headphones,DEV=0
+                    m = re.match(r"card \d+: (\S+) .*device (\d+):", line)
+                    if m and name not in self.output_devices:
+                        self.output_devices[name] = f"plughw:CARD={m.group(1)},DEV={m.group(2)}"
                     outputs.append(name)
+            if os.path.exists("/usr/share/alsa/alsa.conf.d/20-bluealsa.conf"):
+                self.output_devices["Bluetooth"] = "bluealsa"
+                outputs.append("Bluetooth")
             return list(dict.fromkeys(outputs))
         except:
             return ["3.5mm Jack"]
 
+    def open_output(self):
+        """(Re)opens the engine on the selected output with that output's tuned buffer and rate."""
+        prof = self.tuner.profile(self.audio_output)
+        self.engine.open(self.output_devices.get(self.audio_output), prof["rate"], prof["buffer"])
+        self.tuner.pending = False
+
+    def reopen_output(self, engine_name=None):
+        """Switches outputs or engines mid-track, then resumes where we were."""
+        pos = self.engine.position()
+        try:
+            if engine_name and engine_name != self.engine.name:
+                self.engine.close()
+                self.engine = self.make_engine(engine_name)
+            self.open_output()
+            if self.track_file:
+                self.engine.load(self.prefetcher.local(self.track_file), start=pos, index=self.frame_index)
+                if self.is_paused:
+                    self.engine.pause()
+                self.prime_next()
+        except Exception as e:
+            print(f"Audio Init Error: {e}")
+            if self.engine.name != "pygame":
+                # Don't leave a half-opened engine silent, and don't keep it for the next boot
+                self.engine_name = "pygame"
+                self.save_settings()
+                self.reopen_output("pygame")
+
+    def make_engine(self, name):
+        engine = ENGINES.get(name, PygameEngine)()
+        engine.volume = self.vol_level
+        if isinstance(engine, DspEngine):
+            engine.eq.budget = self.dsp_budget
+            engine.set_eq(self.eq_preset)
+        return engine
+
+    def set_engine(self, name):
+        self.engine_name = name
+        self.save_settings()
+        self.reopen_output(name)
+
+    def set_eq(self, preset):
+        """The EQ lives in the DSP engine, so picking a curve other than FLAT switches to it."""
+        self.eq_preset = preset
+        if isinstance(self.engine, DspEngine):
+            self.engine.set_eq(preset)
+            self.save_settings()
+        elif preset != "FLAT":
+            self.set_engine("dsp")
+        else:
+            self.save_settings()
+
     def set_bt_mode(self, mode):
         if mode == "INPUT":
             os.system("sudo hciconfig hci0 class 0x20041C")
@@ -799,56 +2779,428 @@ class App(tk.Tk):
             os.system("sudo hciconfig hci0 class 0x000100")
             subprocess.run(["bluetoothctl", "discoverable", "off"])
 
-    def play_track(self, playlist, index, path, increment=False):
-        self.playlist = playlist
-        self.path = path
-        if increment:
-            next_idx = self.idx + 1
-            if next_idx < len(self.playlist):
-                self.idx = next_idx
-            else:
-                if self.repeat_state:
-                    self.idx = 0
-                else:
-                    pygame.mixer.music.stop()
-                    self._switching = self._processing_event = False
-                    return
+    def play_track(self, playlist, index, path):
+        """Replaces the queue with one folder's tracks and starts at `index`."""
+        self.m3u_gen += 1
+        self.queue.clear()
+        slots = [self.queue.append(self.library.add(os.path.join(path, f))) for f in playlist]
+        self.play_slot(slots[index])
+
+    def track_ended(self):
+        self.finish_track(PlayHistory.COMPLETE, self.track_length)
+        slot = self.queue.step(1, wrap=self.repeat_state)
+        if slot < 0:
+            self.engine.stop()
+            self._switching = self._processing_event = False
+            self.emit("stopped")
+            return
+        self.play_slot(slot)
+
+    def skip(self, d):
+        if not len(self.queue): return
+        self.play_slot(self.queue.step(d), d)
+
+    def enqueue(self, paths, play_next=False):
+        """Adds tracks from anywhere in the library; starts playback if nothing is loaded."""
+        after = self.queue.cur if play_next and self.queue.cur >= 0 else self.queue.tail
+        first = None
+        for p in paths:
+            after = self.queue.insert_after(after, self.library.add(p))
+            if first is None:
+                first = after
+        if first is not None and self.track_file is None:
+            self.play_slot(first)
         else:
-            self.idx = index
-        try:
-            pygame.mixer.music.set_endevent(0)
-            track_file = os.path.join(self.path, self.playlist[self.idx])
-            pygame.mixer.music.stop()
-            pygame.mixer.music.load(track_file)
-            pygame.mixer.music.set_volume(self.vol_level)
-            pygame.mixer.music.play()
-            pygame.mixer.music.set_endevent(MUSIC_END)
+            self.prime_next()
+        self.emit("queue", size=len(self.queue))
+
+    def load_m3u(self, m3u_path):
+        """Streams a playlist file into a fresh queue in batches, the first batch starts playing."""
+        self.m3u_gen += 1
+        gen = self.m3u_gen
+        # Stop the old track now: an empty or unreadable playlist must not leave it playing
+        # with track_file already cleared and no way to control it
+        if self.track_file:
+            self.finish_track(PlayHistory.SKIP, self.engine.position())
+            self.engine.stop()
+            self.emit("stopped")
+        self.queue.clear()
+        self.track_file = None
+
+        def reader():
+            batch = []
+            try:
+                for p in iter_m3u(m3u_path):
+                    batch.append(p)
+                    if len(batch) >= 500:
+                        self.post(self.add_m3u_batch, gen, batch)
+                        batch = []
+                        if gen != self.m3u_gen: return
+            except OSError as e:
+                print(f"Playlist Error: {e}")
+            if batch:
+                self.post(self.add_m3u_batch, gen, batch)
+
+        threading.Thread(target=reader, daemon=True).start()
+
+    def add_m3u_batch(self, gen, batch):
+        if gen == self.m3u_gen:
+            self.enqueue(batch)
+
+    @staticmethod
+    def folder_key(path):
+        return natural_key(os.path.basename(path)), path
+
+    def library_changed(self, added, removed, touched):
+        """Applies one watcher batch. The list is replaced, not mutated, so readers on other threads stay safe."""
+        folders = [f for f in self.library_folders if f not in removed] if removed else list(self.library_folders)
+        for path in added:
+            bisect.insort(folders, path, key=self.folder_key)
+        self.library_folders = folders
+        for folder in touched:
+            self.img_cache.invalidate(os.path.join(folder, "cover.png"))
+        if not self.low_power:
+            self.frames["MP3Menu"].library_changed(added, removed, touched)
+        self.emit("library", added=sorted(added), removed=sorted(removed), changed=sorted(touched))
+
+    def resolve_folder(self, folder):
+        """Accepts a full path or just a folder name from any library root."""
+        if folder in self.library_folders:
+            return folder
+        for path in self.library_folders:
+            if os.path.basename(path) == folder:
+                return path
+        raise KeyError(folder)
+
+    def play_slot(self, slot, d=1):
+        """Plays `slot`; entries that fail to load (stale M3U lines) are dropped, going on in direction d."""
+        self.finish_track(PlayHistory.SKIP, self.engine.position())
+        if self.tuner.pending:
+            # Apply a retuned buffer between tracks, where the reopen gap can't be heard
+            try:
+                self.open_output()
+            except Exception as e:
+                print(f"Audio Init Error: {e}")
+        dropped = False
+        while slot >= 0:
+            self.queue.cur = slot
+            path = self.library.path(self.queue.current())
+            try:
+                self.engine.load(self.prefetcher.local(path))
+            except Exception as e:
+                print(f"Playback Error: {e}")
+                nxt = self.queue.step(d, wrap=self.repeat_state)
+                self.queue.remove(slot)
+                slot = -1 if nxt == slot else nxt
+                dropped = True
+                continue
+            self.track_file = path
             self.is_paused = False
+            self.track_started()
+            break
+        else:
+            # Nothing playable left: don't keep pointing at a track that never started
+            self.track_file = None
+            self.engine.stop()
             self._switching = self._processing_event = False
-            self.reset_sleep_timer()
-            if self.current_screen == "NowPlaying":
-                self.frames["NowPlaying"].refresh()
-            else:
-                self.show_frame("NowPlaying")
+            self.emit("stopped")
+        if dropped:
+            self.emit("queue", size=len(self.queue))
+
+    def track_advanced(self):
+        """The engine already moved on to the primed track by itself."""
+        self.finish_track(PlayHistory.COMPLETE, self.track_length)
+        self.queue.cur = self.primed_slot
+        self.track_file = self.library.path(self.queue.current())
+        if self.tuner.pending:
+            # Gapless playback never passes through play_slot, so apply the retune here, a moment
+            # into the new track. Resume where it got to so its opening isn't heard twice.
+            try:
+                pos = self.engine.position()
+                self.open_output()
+                self.engine.load(self.prefetcher.local(self.track_file), start=pos)
+                self.is_paused = False
+            except Exception as e:
+                print(f"Audio Init Error: {e}")
+        self.track_started()
+
+    def finish_track(self, kind, secs):
+        """Logs how the current track was left; only the first call per track counts."""
+        if self.played:
+            self.history.record(kind, self.played, secs)
+            self.played = None
+
+    def track_started(self):
+        self.played = self.track_file
+        self.history.record(PlayHistory.START, self.track_file)
+        self.prefetcher.started(self.track_file)
+        self.load_frame_index(self.track_file)
+        self.prime_next()
+        self._switching = self._processing_event = False
+        self.emit("track", **self.status())
+        if self.low_power:
+            # Auto-advance with the screen off: the wake-up redraw will pick the new track up
+            self.current_screen = "NowPlaying"
+            self.frames["NowPlaying"].tkraise()
+            return
+        self.reset_sleep_timer()
+        if self.current_screen == "NowPlaying":
+            self.frames["NowPlaying"].refresh()
+        else:
+            self.show_frame("NowPlaying")
+
+    def prime_next(self):
+        """Tells the engine what follows so it can roll over without a gap. Rerun after queue edits."""
+        if not self.track_file: return
+        self.primed_slot = self.queue.step(1, wrap=self.repeat_state)
+        upcoming, slot = [], self.primed_slot
+        while slot >= 0 and len(upcoming) < max(1, self.prefetch_depth):
+            upcoming.append(self.library.path(self.queue.tracks[slot]))
+            slot = self.queue.nxt[slot]
+            if slot < 0 and self.repeat_state: slot = self.queue.head
+            if slot == self.queue.cur: break
+        self.prefetcher.want(upcoming)
+        path = self.prefetcher.local(upcoming[0]) if upcoming else None
+        if path != self.engine.next_path:
+            self.engine.queue_next(path)
+
+    def load_frame_index(self, track_file):
+        """Builds (or reuses) the frame index off the Tk thread, a 2h mix takes a while to scan."""
+        self.frame_index = None
+        try:
+            key = (track_file, os.path.getmtime(track_file))
+        except OSError:
+            return
+        if key in self.frame_index_cache:
+            self.frame_index = self.frame_index_cache[key]
+            self.track_length = self.frame_index.duration
+            return
+        try:
+            self.track_length = MP3(track_file).info.length
+        except:
+            self.track_length = 0
+
+        def build():
+            try:
+                index = MP3FrameIndex(track_file)
+            except Exception as e:
+                print(f"Frame Index Error: {e}")
+                return
+            self.frame_index_cache[key] = index
+            while len(self.frame_index_cache) > 32:
+                self.frame_index_cache.pop(next(iter(self.frame_index_cache)))
+            if self.track_file == track_file:
+                self.frame_index = index
+                self.track_length = index.duration
+
+        threading.Thread(target=build, daemon=True).start()
+
+    def seek(self, secs):
+        if not self.track_file: return
+        secs = max(0.0, min(secs, self.track_length - 1 if self.track_length else secs))
+        try:
+            secs = self.engine.seek(secs, self.frame_index)
+            self.emit("seek", pos=secs)
         except Exception as e:
-            self._switching = self._processing_event = False
-            print(f"Playback Error: {e}")
+            print(f"Seek Error: {e}")
 
-    def check_pygame_events(self):
-        for event in pygame.event.get():
-            if event.type == MUSIC_END:
+    def toggle_pause(self):
+        if not self.track_file: return
+        if self.is_paused:
+            self.engine.resume(); self.is_paused = False
+        else:
+            self.engine.pause(); self.is_paused = True
+        if not self.low_power:
+            self.frames["NowPlaying"].update_visuals()
+        self.emit("paused" if self.is_paused else "resumed", pos=self.engine.position())
+
+    def set_repeat(self, on):
+        self.repeat_state = on
+        self.prime_next()
+        self.save_settings()
+        if not self.low_power:
+            self.frames["NowPlaying"].update_visuals()
+        self.emit("repeat", on=on)
+
+    def set_volume(self, idx):
+        self.vol_idx = max(0, min(idx, len(self.vol_presets) - 1))
+        self.vol_level = self.vol_presets[self.vol_idx] / 100.0
+        self.engine.set_volume(self.vol_level)
+        self.save_settings()
+        if not self.low_power:
+            self.frames["NowPlaying"].update_vol_bar()
+        self.emit("volume", percent=self.vol_presets[self.vol_idx])
+
+    def adjust_volume(self, d):
+        self.set_volume(self.vol_idx + d)
+
+    # --- Control API plumbing ---
+
+    def post(self, fn, *args):
+        """Queues fn to run on the Tk thread, safe to call from any thread."""
+        self.main_calls.put((fn, args))
+
+    def run_main_calls(self):
+        while True:
+            try:
+                fn, args = self.main_calls.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Main Call Error: {e}")
+
+    def emit(self, event, **data):
+        if self.control:
+            self.control.publish(event, **data)
+
+    def set_control_api(self, on):
+        self.control_api = on
+        self.save_settings()
+        if on and not self.control:
+            self.control = ControlServer(self)
+            self.control.start()
+        elif not on and self.control:
+            self.control.stop()
+            self.control = None
+
+    def status(self):
+        tf = self.track_file
+        return {"track": os.path.basename(tf) if tf else None,
+                "folder": os.path.basename(os.path.dirname(tf)) if tf else None,
+                "slot": self.queue.cur, "queued": len(self.queue), "length": self.track_length,
+                "pos": self.engine.position(), "paused": self.is_paused, "engine": self.engine.name,
+                "volume": self.vol_presets[self.vol_idx], "repeat": self.repeat_state}
+
+    def run_command(self, cmd, msg, done):
+        try:
+            if cmd == "status":
+                pass
+            elif cmd == "play":
+                if "folder" in msg:
+                    path = self.resolve_folder(msg["folder"])
+                    songs = natural_sort([f for f in os.listdir(path) if f.endswith(".mp3")])
+                    self.play_track(songs, int(msg.get("index", 0)), path)
+                elif self.is_paused:
+                    self.toggle_pause()
+            elif cmd == "pause":
+                if not self.is_paused:
+                    self.toggle_pause()
+            elif cmd == "toggle":
+                self.toggle_pause()
+            elif cmd in ("next", "prev"):
+                self.skip(1 if cmd == "next" else -1)
+            elif cmd == "seek":
+                self.seek(float(msg["pos"]) if "pos" in msg else self.engine.position() + float(msg.get("delta", 0)))
+            elif cmd == "volume":
+                self.set_volume(int(msg["idx"]) if "idx" in msg else self.vol_idx + int(msg.get("delta", 0)))
+            elif cmd == "repeat":
+                self.set_repeat(bool(msg.get("on", not self.repeat_state)))
+            elif cmd == "stats":
+                done({"img_cache": self.img_cache.stats(), "underruns": self.tuner.underruns,
+                      "prefetch": self.prefetcher.stats(),
+                      "dsp": {"preset": self.eq_preset, "load": self.engine.eq.load,
+                              "bypassed": self.engine.eq.bypassed} if isinstance(self.engine, DspEngine) else None,
+                      "audio": dict(self.tuner.profile(self.audio_output), output=self.audio_output)})
+                return
+            elif cmd == "history":
+                done({"recent": list(self.history.recent),
+                      "most_played": [{"path": p, "plays": n} for p, n in self.history.most_played()]})
+                return
+            elif cmd == "queue":
+                done({"current": self.queue.cur,
+                      "tracks": [{"slot": slot, "path": self.library.path(tid)} for slot, tid in self.queue]})
+                return
+            elif cmd == "enqueue":
+                self.enqueue(msg["paths"], play_next=bool(msg.get("next")))
+            elif cmd == "jump":
+                if not self.queue.valid(int(msg["slot"])): raise KeyError(msg["slot"])
+                self.play_slot(int(msg["slot"]))
+            elif cmd == "remove":
+                self.queue.remove(int(msg["slot"]))
+                self.prime_next()
+                self.emit("queue", size=len(self.queue))
+            elif cmd == "move":
+                self.queue.move(int(msg["slot"]), int(msg.get("after", -1)))
+                self.prime_next()
+                self.emit("queue", size=len(self.queue))
+            elif cmd == "load_m3u":
+                self.load_m3u(msg["path"])
+            elif cmd == "engine":
+                if msg["name"] not in ENGINES: raise ValueError(f"unknown engine: {msg['name']}")
+                self.set_engine(msg["name"])
+            else:
+                raise ValueError(f"unknown command: {cmd}")
+            done(self.status())
+        except Exception as e:
+            done(None, e)
+
+    def query_library(self, cmd, msg):
+        """Runs on the control thread's executor, so it must not touch Tk."""
+        if cmd == "playlists":
+            return [{"name": os.path.basename(p), "path": p} for p in self.library_folders]
+        path = self.resolve_folder(msg["folder"])
+        return natural_sort([f for f in os.listdir(path) if f.endswith(".mp3")])
+
+    def check_audio_events(self):
+        # Doubles as the watchdog heartbeat: it is the one loop that keeps running with the screen off
+        self.watchdog.tick()
+        self.run_main_calls()
+        self.tuner_ticks += 1
+        if self.tuner_ticks >= 20 and self.track_file and not self.is_paused:
+            self.tuner_ticks = 0
+            if self.tuner.poll(self.audio_output):
+                self.save_settings()
+        for event in self.engine.poll():
+            if event == "advanced":
+                self.track_advanced()
+            elif event == "ended":
                 if self._processing_event or self.is_paused: continue
-                if self.playlist:
+                if len(self.queue):
                     self._processing_event = True
                     self._switching = True
-                    self.after(200, lambda: self.play_track(self.playlist, self.idx, self.path, increment=True))
-        self.after(100, self.check_pygame_events)
+                    self.after(200, self.track_ended)
+        self.after(100, self.check_audio_events)
+
+    def handle_key_release(self, event):
+        self._released = (event.keysym, event.time)
+        # An autorepeat press with the same timestamp follows at once, a real release doesn't
+        self.after(30, self.check_release, event.keysym, event.time)
+
+    def check_release(self, key, t):
+        if self._released == (key, t):
+            self.release_key(key)
+
+    def release_key(self, key):
+        """A Left/Right tap on a scrubbable screen only moves once we know it wasn't a hold."""
+        if not self._tap or self._tap[0] != key: return
+        f = self._tap[1]
+        self._tap = None
+        if self.frames.get(self.current_screen) is f:
+            f.move(-1 if key in ("Left", "4") else 1, False)
 
     def handle_keys(self, event):
+        self.last_input = (event.keysym, time.time())
         self.reset_sleep_timer()
         if self.current_screen not in self.frames: return
         f = self.frames[self.current_screen]
         key = event.keysym
+        # X11 autorepeat sends a release/press pair with the same timestamp, GPIO holds are flagged
+        held = getattr(event, "held", False) or self._released == (key, getattr(event, "time", None))
+        if held:
+            self._released = None
+        scrubbable = key in ("Left", "4", "Right", "6") and hasattr(f, "scrub")
+        if held and scrubbable:
+            self._tap = None
+            f.scrub(-1 if key in ("Left", "4") else 1)
+            return
+        if held and key in ("Return", "5", "space"):
+            return
+        if scrubbable and not held:
+            # Tap or hold isn't known yet: the move waits for release_key
+            self._tap = (key, f)
+            return
         if key in ("Up", "8"):
             f.move(-1, True)
         elif key in ("Down", "2"):
@@ -861,9 +3213,12 @@ class App(tk.Tk):
             f.select()
         elif key in ("s", "S"):
             self.show_frame("SettingsMenu")
+        elif key in ("q", "n") and hasattr(f, "queue_selected"):
+            f.queue_selected(play_next=key == "n")
 
     def show_frame(self, cont):
         self.current_screen = cont
+        self.emit("screen", name=cont)
         frame = self.frames[cont]
         frame.tkraise()
         if hasattr(frame, 'refresh'): self.after(20, frame.refresh)
@@ -877,8 +3232,19 @@ class App(tk.Tk):
                     self.repeat_state = d.get("repeat", False)
                     self.sleep_idx = d.get("sleep_idx", 0)
                     self.audio_output = d.get("audio_output", "3.5mm Jack")
+                    self.audio_profiles = d.get("audio_profiles", {})
+                    self.engine_name = d.get("engine", "pygame")
+                    self.eq_preset = d.get("eq_preset", "FLAT")
+                    self.dsp_budget = d.get("dsp_budget", 0.25)
+                    self.library_roots = d.get("library_roots", [MUSIC_ROOT])
+                    self.auto_mounts = d.get("auto_mounts", True)
+                    self.prefetch_depth = d.get("prefetch_depth", 2)
+                    self.stage_mb = d.get("stage_mb", 0)
                     self.fps_cap = d.get("fps_cap", 30)
                     self.resolution_mode = d.get("resolution_mode", "800x480")
+                    self.control_api = d.get("control_api", False)
+                    self.img_cache_mb = d.get("img_cache_mb", 24)
+                    self.stall_threshold = d.get("stall_threshold", 2.0)
             except:
                 pass
 
@@ -886,43 +3252,98 @@ class App(tk.Tk):
         try:
             data = {"vol_idx": self.vol_idx, "repeat": self.repeat_state,
                     "sleep_idx": self.sleep_idx, "audio_output": self.audio_output,
-                    "fps_cap": self.fps_cap, "resolution_mode": self.resolution_mode}
+                    "audio_profiles": self.audio_profiles, "engine": self.engine_name,
+                    "eq_preset": self.eq_preset, "dsp_budget": self.dsp_budget,
+                    "library_roots": self.library_roots, "auto_mounts": self.auto_mounts,
+                    "prefetch_depth": self.prefetch_depth, "stage_mb": self.stage_mb,
+                    "fps_cap": self.fps_cap, "resolution_mode": self.resolution_mode,
+                    "control_api": self.control_api, "img_cache_mb": self.img_cache_mb,
+                    "stall_threshold": self.stall_threshold}
             with open(self.settings_file, "w") as f:
                 json.dump(data, f)
         except:
             pass
 
     def set_screen_state(self, on=True):
-        state = "1" if on else "0"
-        os.system(f"vcgencmd display_power {state}")
+        try:
+            # bl_power is inverted: 0 is on
+            with open(self.backlight, "w") as f:
+                f.write("0" if on else "1")
+            return
+        except (TypeError, OSError):
+            pass
+        try:
+            subprocess.Popen(["vcgencmd", "display_power", "1" if on else "0"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            pass
+
+    def enter_low_power(self):
+        """Screen off: stop every UI timer, only check_audio_events keeps ticking for audio."""
+        self.screen_on = False
+        self.low_power = True
+        self.top_bar.suspend()
+        for frame in self.frames.values():
+            if hasattr(frame, "suspend"): frame.suspend()
+        self.set_screen_state(False)
+        self.history.flush()
+        self.emit("screen_off")
+
+    def exit_low_power(self):
+        self.screen_on = True
+        self.low_power = False
+        self.top_bar.update_bar()
+        if self.current_screen:
+            self.show_frame(self.current_screen)
+        self.set_screen_state(True)
+        self.emit("screen_on")
 
     def reset_sleep_timer(self):
         self.last_input_time = time.time()
         if not self.screen_on:
-            self.screen_on = True
-            self.set_screen_state(True)
+            self.exit_low_power()
+        if self.sleep_after:
+            self.after_cancel(self.sleep_after)
+            self.sleep_after = None
+        limit = self.sleep_limit()
+        if limit:
+            self.sleep_after = self.after(int(limit * 1000), self.check_sleep_timer)
+
+    def sleep_limit(self):
+        times = {"15S": 15, "30S": 30, "1M": 60, "2M": 120}
+        return times.get(self.sleep_opts[self.sleep_idx], 0)
 
     def check_sleep_timer(self):
-        if self.sleep_idx > 0:
-            times = {"15S": 15, "30S": 30, "1M": 60, "2M": 120}
-            limit = times.get(self.sleep_opts[self.sleep_idx], 999)
-            if time.time() - self.last_input_time > limit and self.screen_on:
-                self.screen_on = False
-                self.set_screen_state(False)
-        self.after(1000, self.check_sleep_timer)
+        # Scheduled for the deadline instead of polled every second
+        self.sleep_after = None
+        limit = self.sleep_limit()
+        if not limit or not self.screen_on: return
+        left = limit - (time.time() - self.last_input_time)
+        if left > 0:
+            self.sleep_after = self.after(int(left * 1000) + 50, self.check_sleep_timer)
+        else:
+            self.enter_low_power()
 
     def setup_gpio(self):
         try:
             pins = {22: "Up", 27: "Down", 17: "Left", 23: "Right", 24: "Return"}
             self.physical_buttons = []
             for pin, key in pins.items():
-                btn = GPIOButton(pin, bounce_time=0.05)
+                btn = GPIOButton(pin, bounce_time=0.05, hold_time=0.4, hold_repeat=True)
                 btn.when_pressed = lambda k=key: self.handle_keys(type('obj', (object,), {'keysym': k}))
+                btn.when_held = lambda k=key: self.handle_keys(type('obj', (object,), {'keysym': k, 'held': True}))
+                btn.when_released = lambda k=key: self.release_key(k)
                 self.physical_buttons.append(btn)
         except:
             pass
 
 
 if __name__ == "__main__":
+    if "--bench-dsp" in sys.argv:
+        if np is None:
+            sys.exit("--bench-dsp needs numpy")
+        bench_dsp()
+        sys.exit(0)
     app = App();
-    app.mainloop()
\ No newline at end of file
+    app.mainloop()
+    app.history.flush()
\ No newline at end of file